@@ -42,7 +42,9 @@ WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 #   matplotlib for plotting                             https://matplotlib.org/
 #   numpy for some statistics                           https://numpy.org
 #   scipy for Savitsky-Golay filtering                  https://scipy.org
-#   xlsxwriter to generate Excel-compatible .xlsx files https://pypi.org/project/XlsxWriter/
+#   xlsxwriter to generate Excel-compatible .xlsx files https://pypi.org/project/XlsxWriter/ (only for -spreadsheet)
+# Optional:
+#   orjson for faster N2K JSON parsing                  https://pypi.org/project/orjson/
 
 deg = u'\N{DEGREE SIGN}'
 
@@ -53,15 +55,28 @@ import os
 import os.path
 import datetime
 import subprocess
-from math import sqrt, sin, cos, pi, tau, radians, degrees, atan2, fmod
-from statistics import mean
+import itertools
+import functools
+import concurrent.futures
+import mmap
+from math import sin, cos, pi, tau, radians, degrees
 import numpy as np
+import matplotlib
+matplotlib.use('Agg') # Only ever write image files, so don't load a GUI backend
 import matplotlib.pyplot as plt
+import matplotlib.colors
 import matplotlib.dates as mdates
 import scipy.signal
+import scipy.ndimage
 import json
 import argparse
-import xlsxwriter
+
+# orjson is a much faster JSON parser for the analyzer output - use it if it's installed
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 regattalist = []
 regattas = {}
@@ -114,12 +129,58 @@ BOUNDS = None
 cmap = [ '#C23B23', '#F39A27', '#03C03C', '#579ABE', '#976ED7', '#EADA52']
 
 # Convert meters per second to knots
+MS2KTS = 1.94384 # knots per meter/second
+
 def ms2kts(ms):
-    return(ms * 1.94384)
+    return(ms * MS2KTS)
+
+# Savitzky-Golay smoothing with a 7 sample window and a cubic fit
+# The filter coefficients are the same every time, so only compute them once
+SAVGOL73 = scipy.signal.savgol_coeffs(7, 3)
+
+def savgol73(y):
+    # Repeat the end values past the edges so short runs (fewer than 7 points) can be smoothed too
+    return(scipy.ndimage.convolve1d(np.asarray(y, dtype=np.float64), SAVGOL73, mode='nearest'))
 
 def addtz(ts):
     return("%s" % (ts + tzoffset))
 
+@functools.lru_cache(maxsize=None)
+def local_time(ts, offset):
+    # HH:MM:SS in the regatta's timezone - the same times show up in several reports
+    return(("%s" % (ts + offset))[11:])
+
+# Raw samples are timestamped in integer milliseconds since the Unix epoch (UTC)
+# Only convert back to datetime when reporting
+epoch = datetime.datetime(year=1970, month=1, day=1)
+
+def epoch_ms(ts):
+    return((ts - epoch) // datetime.timedelta(milliseconds=1))
+
+def ms_datetime(ms):
+    return(epoch + datetime.timedelta(milliseconds=ms))
+
+# Days since the epoch for each date string we've seen in N2K timestamps
+n2k_days = {}
+
+def n2k_ts_ms(t):
+    # Analyzer timestamps are fixed width YYYY-MM-DD-HH:MM:SS.sss - only whole seconds are kept
+    day = n2k_days.get(t[:10])
+    if day == None:
+        day = epoch_ms(datetime.datetime.fromisoformat(t[:10]))
+        n2k_days[t[:10]] = day
+    return(day + ((int(t[11:13]) * 60 + int(t[14:16])) * 60 + int(t[17:19])) * 1000)
+
+def regatta_settings(e):
+    # Set the per-regatta parser settings and time zone from the regatta's description
+    global rudderCorrection, STWCorrection, LATLONSOURCE, COGSOGSOURCE, BOUNDS, tzoffset
+    rudderCorrection = 0.0 if not 'rudderCorrection' in e else float(e['rudderCorrection'])
+    STWCorrection = 1.0 if not 'STWCorrection' in e else float(e['STWCorrection'])
+    LATLONSOURCE = None if not 'latlonSource' in e else int(e['latlonSource'])
+    COGSOGSOURCE = None if not 'cogsogSource' in e else int(e['cogsogSource'])
+    BOUNDS = None if not 'bounds' in e else e['bounds']
+    tzoffset = e['tzoffset']
+
 def parse_regatta(fn):
     # Parse a regatta description, which is a JSON file composed of a list of dictionary elements.
     # Each element is a "regatta", "race", or "course"
@@ -144,27 +205,23 @@ def parse_regatta(fn):
             regatta["races"] = []
             regatta["courses"] = {}
             regatta["marks"] = {}
-            global rudderCorrection
-            rudderCorrection = 0.0 if not 'rudderCorrection' in e else float(e['rudderCorrection'])
+            # Work out the time zone once; regatta_settings makes it the global for this regatta
+            regatta["tzoffset"] = datetime.timedelta(0) if not 'tz' in e else datetime.timedelta(hours=float(e['tz']))
+            regatta_settings(e)
             print("## Setting rudder correction to %4.1f%s" % (rudderCorrection, deg))
-            global STWCorrection
-            STWCorrection = 1.0 if not 'STWCorrection' in e else float(e['STWCorrection'])
             print("## Setting STW correction to %5.2f%s" % (STWCorrection * 100, "%"))
-            global LATLONSOURCE, COGSOGSOURCE
-            LATLONSOURCE = None if not 'latlonSource' in e else int(e['latlonSource'])
-            COGSOGSOURCE = None if not 'cogsogSource' in e else int(e['cogsogSource'])
-            tzoffset = datetime.timedelta(0) if not 'tz' in e else datetime.timedelta(hours=int(e['tz']))
             print("## Parse Regatta %s" % (name))
-            global BOUNDS
-            BOUNDS = None if not 'bounds' in e else e['bounds']
             if not BOUNDS is None:
                 print("## Bounds: %r" % (BOUNDS))
         elif "race" in e:
             ## print("## Parse Race %r" % (e))
-            e['startts'] = datetime.datetime.strptime(e['start'], '%Y-%m-%dT%H:%M:%S') - tzoffset
-            e['endts'] = datetime.datetime.strptime(e['end'], '%Y-%m-%dT%H:%M:%S') - tzoffset
+            e['startts'] = datetime.datetime.fromisoformat(e['start']) - tzoffset
+            e['endts'] = datetime.datetime.fromisoformat(e['end']) - tzoffset
+            e['startts_ms'] = epoch_ms(e['startts'])
+            e['endts_ms'] = epoch_ms(e['endts'])
+            e['outbase'] = "%s_%s_%s" % (regatta['boat'], regatta['basefn'], e['race']) # start of each per-race output file name
             for f in raceRawFields:
-                e[f] = []
+                e[f] = [] if f == 'LATLON' else Channel()
             regatta["races"].append(e) # Add this to the list of races
             print("## Parse Race %s - Course %s %s - %s" % (e['race'], e['course'], e['startts'], e['endts']))
         elif "course" in e:
@@ -208,173 +265,159 @@ Count Sntnce *     Description
 5887  $GPRMC   RMC Navigation info
 """
 
-# NMEA 0183 sentences we use
-interesting_sentences = ["$SDHDG", # Heading
-                         "$WIMWV", # Wind data
-                         "$PSIQREC", # SeaIQ Time stamps
-                         "$IIXDR", # Transducer measurement w/ rudder angle
-                         "$GPGLL", # LAT/LON
-                         "$SDVHW", # Water speed - and heading?
-                         "$GPZDA", # Time stamp
-                         "$GPVTG"] # COG/SOG
-    
 def legInit(l):
     for f in legRawFields:
         l[f] = []
-    l['startts'] = datetime.datetime.strptime(l['start'], '%Y-%m-%dT%H:%M:%S') - tzoffset
-    l['endts'] = datetime.datetime.strptime(l['end'], '%Y-%m-%dT%H:%M:%S') - tzoffset
+    l['startts'] = datetime.datetime.fromisoformat(l['start']) - tzoffset
+    l['endts'] = datetime.datetime.fromisoformat(l['end']) - tzoffset
+    l['startts_ms'] = epoch_ms(l['startts'])
+    l['endts_ms'] = epoch_ms(l['endts'])
     l['duration'] = l['endts'] - l['startts']
     l['sindex'] = {}
     l['eindex'] = {}
     print("## Init leg %s - %s" % (l['startts'], l['endts']))
 
-interesting_sentences = ["$SDHDG", # Heading
-                         "$WIMWV", # Wind data
-                         "$PSIQREC", # SeaIQ Time stamps
-                         "$GPGLL", # LAT/LON
-                         "$SDVHW", # Water speed - and heading?
-                         "$GPZDA", # Time stamp
-                         "$GPVTG"] # COG/SOG
+# Per-sentence parsers for NMEA 0183 data. Each appends its data to the race and returns the number of samples kept
+def nmea_gll(fields, r, ts):
+    # LAT/LON
+    # $GPGLL,3748.8071,N,12227.9801,W,191614,A,A*5D
+    # Remember to make South and West negative
+    lat1, lat2 = fields[1].split('.')
+    n = fields[2] == 'N'
+    lat = (float(lat1[0:-2]) + (float(lat1[-2:] + '.' + lat2)/60)) * (1 if n else -1)
+
+    lon1, lon2 = fields[3].split('.')
+    e = fields[4] == 'E'
+    lon = (float(lon1[0:-2]) + (float(lon1[-2:] + '.' + lon2)/60)) * (1 if e else -1)
+
+    r['LATLON'].append((ts, lat, lon))
+    return(1)
+
+def nmea_hdg(fields, r, ts):
+    # Heading
+    # $SDHDG,336.4,,,13.3,E*06
+    if fields[4] != '':
+        east = fields[5] == 'E'
+        variation = float(fields[4]) * (1 if east else -1)
+        if r['variation'] != variation:
+            r['variation'] = variation
+            # print("Setting compass variation to %.1f" % (variation))
+    hdg = float(fields[1])
+    r['HDG'].push(ts, hdg)
+    return(1)
+
+def nmea_mwv(fields, r, ts):
+    # Wind data
+    # $WIMWV,336.8,R,18.7,N,A*13
+    # $WIMWV,324.6,T,13.0,N,A*14
+    if fields[4] == 'N':
+        speed = float(fields[3])
+    elif fields[4] == 'M':
+        speed = ms2kts(float(fields[3]))
+    if fields[2] == 'R':
+        # Apparent wind - should make sure it's in knots
+        awa = float(fields[1]) # race_arrays converts to +/- 180
+        r['AWA'].push(ts, awa)
+        r['AWS'].push(ts, speed)
+    if fields[2] == 'T':
+        # True wind - should make sure it's in knots
+        #l['TWA'].append((ts, float(fields[1])))
+        #l['TWS'].append((ts, speed))
+        #  We compute this from smoothed data rather than trust the instrument's calc
+        pass
+    return(0)
+
+def nmea_vhw(fields, r, ts):
+    # Speed through Water (with heading?)
+    # $SDVHW,348.7,T,335.4,M,5.7,N,10.6,K*7E
+    #hdg = float(fields[3]) # Do not believe heading from boat speed sensor
+    stw = float(fields[5]) * STWCorrection
+    r['STW'].push(ts, stw)
+    return(1)
+
+def nmea_vtg(fields, r, ts):
+    # COG/SOG
+    # $GPVTG,342.9,T,329.5,M,5.4,N,10.1,K,A*13
+    cog = float(fields[3]) # use magnetic COG
+    sog = float(fields[5])
+    r['COG'].push(ts, cog)
+    r['SOG'].push(ts, sog)
+    return(1)
+
+# NMEA 0183 sentences we use, keyed by the sentence ID without the talker
+# Not saving $WIMWD (wind direction and speed with respect to north) for now - not sure I believe them
+sentence_handlers = { "GLL": nmea_gll, # $GPGLL LAT/LON
+                      "HDG": nmea_hdg, # $SDHDG Heading
+                      "MWV": nmea_mwv, # $WIMWV Wind data
+                      "VHW": nmea_vhw, # $SDVHW Water speed - and heading?
+                      "VTG": nmea_vtg } # $GPVTG COG/SOG
+
+# Time stamps ($PSIQREC SeaIQ and $GPZDA GPS) are handled in the parse loop since they set the current time
+interesting_ids = set(sentence_handlers) | { "REC", "ZDA" }
 
 def parse_race_0183(regatta, r):
+    # Read the whole file at once; most lines are sentences we don't use
     with open(regatta['path'] + r['data'], 'r') as f:
-        r['variation'] = 0
-        r['LATLON'] = []
-        variation = 0
-        ts = datetime.datetime(year=1970, day=1, month=1, hour=0, minute=0, second=0)
-        sampleCount = 0
-        sentenceCount = 0
-
-        while True:
-            line = f.readline()
-            if not line:
-                break
-            fields = line.split(',')
-
-            # I'm tempted to select on the entire field, but I don't know if some brands emit
-            # some sentences with different talker IDs
-            talker = fields[0][:-3]
-            sentence = fields[0][-3:]
-
-            # Look for timestamps first.
-            if sentence == "REC":
-                # SeaIQ recording timestamp
-                # $PSIQREC,0,1,1572722175.566,20191102,121615
-                # print("## REC %s: %s %s %s" % (line, fields[3], fields[4], fields[5]))
-                y = int(fields[4][0:4])
-                m = int(fields[4][4:6])
-                d = int(fields[4][6:8])
-                h = int(fields[5][0:2])
-                minute = int(fields[5][2:4])
-                s =  int(fields[5][4:6])
-                ms = int(fields[3][-3:])
-                tslocal = datetime.datetime(year=y, month=m, day=d, hour=h, minute=minute, second=s, microsecond=ms*1000)
-                newts = datetime.datetime.utcfromtimestamp(float(fields[3]))
-                delta = newts - ts
-                # Ignore the SeaIQ timestamps - use the ZDA sentence from the B&G
-                #print("## New time REC %s delta %s" % (newts.strftime('%Y-%m-%dT%H:%M:%S'), delta))
-                #ts = newts
-
-            elif sentence == "ZDA":
-                # GPS timestamp
-                # $GPZDA,191614,02,11,2019,07,00*4D
-                # $GPZDA,UTC,Day,Month,Year,TZ-hours,TZ-minutes
-                # UTC is in HHMMSS.xxxx
-                y = int(fields[4])
-                m = int(fields[3])
-                d = int(fields[2])
-                h = int(fields[1][0:2])
-                minute = int(fields[1][2:4])
-                s =  int(fields[1][4:6])
-                newts = datetime.datetime(year=y, month=m, day=d, hour=h, minute=minute, second=s)
-                delta = newts - ts
-                #print("## New time ZDA %s delta %s" % (newts.strftime('%Y-%m-%dT%H:%M:%S'), delta))
-                ts = newts
-
-            if (ts < r['startts']):
-                # Not yet in the race
-                # print("## Not leg %s vs %s" % (ts.strftime('%Y-%m-%dT%H:%M:%S'), r['startts'].strftime('%Y-%m-%dT%H:%M:%S')))
-                continue
-
-            if (ts >= r['endts']):
-                print("## Done %s - %s %d of %d samples" % (r['startts'], r['endts'], sampleCount, sentenceCount))
-                break
-
-            sentenceCount += 1
-            if sentence == "GLL":
-                # LAT/LON
-                # $GPGLL,3748.8071,N,12227.9801,W,191614,A,A*5D
-                # Remember to make South and West negative
-                lat1, lat2 = fields[1].split('.')
-                n = fields[2] == 'N'
-                lat = (float(lat1[0:-2]) + (float(lat1[-2:] + '.' + lat2)/60)) * (1 if n else -1)
-
-                lon1, lon2 = fields[3].split('.')
-                e = fields[4] == 'E'
-                lon = (float(lon1[0:-2]) + (float(lon1[-2:] + '.' + lon2)/60)) * (1 if e else -1)
-
-                r['LATLON'].append((ts, lat, lon))
-                sampleCount += 1
+        lines = f.read().splitlines()
+
+    r['variation'] = 0
+    r['LATLON'] = []
+    ts = 0 # ms since the epoch
+    startts = r['startts_ms']
+    endts = r['endts_ms']
+    sampleCount = 0
+    sentenceCount = 0
+
+    for line in lines:
+        # I'm tempted to select on the entire field, but I don't know if some brands emit
+        # some sentences with different talker IDs
+        comma = line.find(',')
+        sentence = line[comma-3:comma]
+        if not sentence in interesting_ids:
+            if ts >= startts:
+                sentenceCount += 1
+            continue
+        fields = line.split(',')
+
+        # Look for timestamps first.
+        if sentence == "REC":
+            # SeaIQ recording timestamp
+            # $PSIQREC,0,1,1572722175.566,20191102,121615
+            # print("## REC %s: %s %s %s" % (line, fields[3], fields[4], fields[5]))
+            # Ignore the SeaIQ timestamps - use the ZDA sentence from the B&G
+            #newts = int(float(fields[3]) * 1000)
+            #print("## New time REC %s delta %s" % (ms_datetime(newts), newts - ts))
+            #ts = newts
+            pass
+
+        elif sentence == "ZDA":
+            # GPS timestamp
+            # $GPZDA,191614,02,11,2019,07,00*4D
+            # $GPZDA,UTC,Day,Month,Year,TZ-hours,TZ-minutes
+            # UTC is in HHMMSS.xxxx
+            y = int(fields[4])
+            m = int(fields[3])
+            d = int(fields[2])
+            h = int(fields[1][0:2])
+            minute = int(fields[1][2:4])
+            s =  int(fields[1][4:6])
+            newts = epoch_ms(datetime.datetime(year=y, month=m, day=d, hour=h, minute=minute, second=s))
+            #print("## New time ZDA %s delta %s" % (ms_datetime(newts), newts - ts))
+            ts = newts
+
+        if (ts < startts):
+            # Not yet in the race
+            # print("## Not leg %s vs %s" % (ms_datetime(ts), r['startts']))
+            continue
 
-            elif sentence == "HDG":
-                # Heading
-                # $SDHDG,336.4,,,13.3,E*06
-                if fields[4] != '':
-                    east = fields[5] == 'E'
-                    variation = float(fields[4]) * (1 if east else -1)
-                    if r['variation'] != variation:
-                        r['variation'] = variation
-                        variation = variation
-                        # print("Setting compass variation to %.1f" % (variation))
-                hdg = float(fields[1])
-                r['HDG'].append((ts, hdg))
-                sampleCount += 1
+        if (ts >= endts):
+            print("## Done %s - %s %d of %d samples" % (r['startts'], r['endts'], sampleCount, sentenceCount))
+            break
 
-            elif sentence == "MWV":
-                # Wind data
-                # $WIMWV,336.8,R,18.7,N,A*13
-                # $WIMWV,324.6,T,13.0,N,A*14
-                if fields[4] == 'N':
-                    speed = float(fields[3])
-                elif fields[4] == 'M':
-                    speed = m2k(float(fields[3]))
-                if fields[2] == 'R':
-                    # Apparent wind - should make sure it's in knots
-                    awa = float(fields[1])
-                    awa = awa if awa < 180 else awa - 360
-                    r['AWA'].append((ts, awa))
-                    r['AWS'].append((ts, speed))
-                if fields[2] == 'T':
-                    # True wind - should make sure it's in knots
-                    #l['TWA'].append((ts, float(fields[1])))
-                    #l['TWS'].append((ts, speed))
-                    #sampleCount += 1
-                    #  We compute this from smoothed data rather than trust the instrument's calc
-                    pass
-
-            elif sentence == "MWD":
-                # Wind Direction and Speed, with respect to north
-                # $WIMWD,70.4,T,57.1,M,4.7,N,2.4,M*5F
-                #twd = float(fields[3])
-                #tws = float(fields[5])
-                # Not saving these for now - not sure I believe them
-                pass
-
-            elif sentence == "VHW":
-                # Speed through Water (with heading?)
-                # $SDVHW,348.7,T,335.4,M,5.7,N,10.6,K*7E
-                #hdg = float(fields[3]) # Do not believe heading from boat speed sensor
-                stw = float(fields[5]) * STWCorrection
-                r['STW'].append((ts, stw))
-                sampleCount += 1
-            elif sentence == "VTG":
-                # COG/SOG
-                # $GPVTG,342.9,T,329.5,M,5.4,N,10.1,K,A*13
-                cog = float(fields[3]) # use magnetic COG
-                sog = float(fields[5])
-                r['COG'].append((ts, cog))
-                r['SOG'].append((ts, sog))
-                sampleCount += 1
+        sentenceCount += 1
+        handler = sentence_handlers.get(sentence)
+        if handler != None:
+            sampleCount += handler(fields, r, ts)
     print("## Done Race %s %s - %s kept %d of %d pgns" % (r['race'], r['startts'], r['endts'], sampleCount, sentenceCount))
 
             
@@ -401,79 +444,73 @@ def parse_race_n2k(regatta, r):
 
     # If we don't have a JSON file, run the raw log through the analyzer filtering for the PGNs we care about
     if not os.path.isfile(jsonfile):
-        pgnpat = '(' + str(interesting_pgns[0])
-        for pgn in interesting_pgns[1:]:
-            pgnpat += '|' + str(pgn)
-        pgnpat += ')'
+        # Match the PGN key itself rather than grepping for the number anywhere in the line
+        pgnkeys = tuple(b'"pgn":%d,' % (pgn) for pgn in interesting_pgns)
 
         logfile = regatta["path"] + r['data']
         print("Converting N2K %s to %s" % (logfile, jsonfile))
 
-        #with open(logfile, 'r') as infile, open(jsonfile, 'wb') as outfile:
+        if platform.system() == "Windows":
+            # Analyzer has to be run under Cygwin; use bash to start it
+            cwd=os.getcwd().replace('\\', '/')
+            p1cmd = [ 'C:/cygwin64/bin/bash', '--login', '-c', '%s -json -file %s/%s' % (ANALYZER, cwd, logfile) ]
+        else:
+            # Assume Linux / MacOS
+            p1cmd = [ ANALYZER, '-json', '-d', '-file', logfile ]
+
+        # Filter the analyzer output as it streams by instead of piping it through grep
         with open(jsonfile, 'wb') as outfile:
-            if platform.system() == "Windows":
-                # Analyzer has to be run under Cygwin; use bash to start both the analyzer and grep
-                cwd=os.getcwd().replace('\\', '/')
-                p1cmd = [ 'C:/cygwin64/bin/bash', '--login', '-c', '%s -json -file %s/%s' % (ANALYZER, cwd, logfile) ]
-                p2cmd = [ 'C:/cygwin64/bin/bash', '--login', '-c', "grep -E '%s'" % (pgnpat)]
-            else:
-                # Assume Linux / MacOS
-                p1cmd = [ ANALYZER, '-json', '-d', '-file', logfile ]
-                p2cmd = [ '/usr/bin/grep', '-E', pgnpat]
-            #p1 = subprocess.Popen(p1cmd, stdin=infile, stdout=subprocess.PIPE)
-            # Using the -file argument instead of stdin
             p1 = subprocess.Popen(p1cmd, stdout=subprocess.PIPE)
-            p2 = subprocess.Popen(p2cmd, stdin=p1.stdout, stdout=outfile)
-
-            #out1, err1 = p1.communicate()
+            for line in p1.stdout:
+                pgnstart = line.find(b'"pgn":')
+                if pgnstart >= 0 and line.startswith(pgnkeys, pgnstart):
+                    outfile.write(line)
             ret1 = p1.wait()
-            if ret1 == None:
-                print("Analyzer wait() returned None")
-            elif ret1 != 0:
-                print("Analyzer exited with code %d" % (ret1))
-                print("infile %r" % (logfile))
-                print("p1cmd: %r" % (p1cmd))
-                print("p2cmd: %r" % (p2cmd))
-                print("outfile: %r" % (jsonfile))
-                # Not sure how to get stderr - if communicate is called it intercepts stdout being piped to grep
-                #print("stderr: %r" % (err1))
-            else:
-                print("Analyzer exited OK")
-            ret2 = p2.wait()
-
-        if ret2 == None:
-            print("N2K analyze pipe not terminated?")
-            p2.kill()
-            os.remove(jsonfile)
-        elif ret2 != 0:
-            print("N2K analyze pipe exited with code %d" % (ret2))
+
+        if ret1 != 0:
+            # Often just a truncated last frame - parse whatever the analyzer did write
+            print("Analyzer exited with code %d" % (ret1))
+            print("infile %r" % (logfile))
             print("p1cmd: %r" % (p1cmd))
-            print("p2cmd: %r" % (p2cmd))
-            print("Removing %s" % (jsonfile))
-            os.remove(jsonfile)
-            return # maybe should quit program
-        
-    with open(jsonfile, "r") as f:
+            print("outfile: %r" % (jsonfile))
+        else:
+            print("Analyzer exited OK")
+
+    # Reuse the arrays from a previous run if the JSON and the parse settings haven't changed
+    cachefile = jsonfile[:-5] + '.npz'
+    if load_n2k_cache(cachefile, jsonfile, r):
+        print("## Loaded cached N2K data %s" % (cachefile))
+        return
+
+    # Map the JSON file and walk it a line at a time with find() rather than reading it through a buffered file
+    with open(jsonfile, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
         r['variation'] = 0
         r['LATLON'] = []
         variation = 0
         sampleCount = 0
         pgnCount = 0
+        startts = r['startts_ms']
+        endts = r['endts_ms']
 
+        pos = 0
         while True:
-            line = f.readline()
-            if not line:
-                print("## End of data at %s (%s)" % (ts, j['timestamp']))
+            if pos >= len(buf):
+                print("## End of data at %s (%s)" % (ms_datetime(ts), j['timestamp']))
                 break
+            nl = buf.find(b'\n', pos)
+            if nl < 0:
+                nl = len(buf)
+            line = buf[pos:nl]
+            pos = nl + 1
             try:
-                j = json.loads(line)
+                j = json_loads(line)
             except:
                 print("Parse exception %s" % (line))
                 continue
 
             #print("Line %s" % (line))
             #print("JSON %r" % (j))
-            ts = datetime.datetime.strptime(j['timestamp'][:-4], '%Y-%m-%d-%H:%M:%S')
+            ts = n2k_ts_ms(j['timestamp'])
             pgn = j['pgn']
 
             if pgn == 127258:
@@ -483,12 +520,12 @@ def parse_race_n2k(regatta, r):
                     r['variation'] = variation
                     # print("## Setting compass variation to %f" % (variation))
 
-            if (ts < r['startts']):
+            if (ts < startts):
                 # Not yet on the new leg
                 continue
 
             # print("%s vs %s" % (time, r["legs"][leg]["start"]))
-            if (ts >= r['endts']):
+            if (ts >= endts):
                 print("## Done Race %s %s - %s kept %d of %d pgns" % (r['race'], r['startts'], r['endts'], sampleCount, pgnCount))
                 break
 
@@ -513,20 +550,19 @@ def parse_race_n2k(regatta, r):
                         pass
                     else:
                         rudder = j['fields']['Position'] + rudderCorrection
-                        r['RUD'].append((ts, rudder))
+                        r['RUD'].push(ts, rudder)
                 sampleCount += 1
 
             elif pgn == 127250:
                 #{"timestamp":"2019-10-20-19:04:56.308","prio":2,"src":204,"dst":255,"pgn":127250,"description":"Vessel Heading","fields":{"Heading":280.1,"Reference":"Magnetic"}}
                 heading = j['fields']['Heading']
-                r['HDG'].append((ts, heading))
+                r['HDG'].push(ts, heading)
                 sampleCount += 1
 
             elif pgn == 128259:
                 #{"timestamp":"2019-10-20-19:04:56.538","prio":2,"src":35,"dst":255,"pgn":128259,"description":"Speed","fields":{"SID":6,"Speed Water Referenced":1.35,"Speed Water Referenced Type":"Paddle wheel"}}
                 ms = j['fields']['Speed Water Referenced']
-                stw = ms2kts(ms) * STWCorrection
-                r['STW'].append((ts, stw))
+                r['STW'].push(ts, ms * STWCorrection) # m/s - converted to knots after parsing
                 sampleCount += 1
 
             elif pgn == 129026:
@@ -538,35 +574,72 @@ def parse_race_n2k(regatta, r):
                         pass
                     else:
                         cog = j['fields']['COG'] if j['fields']['COG Reference'] != "True" else j['fields']['COG'] - variation
-                        sog = ms2kts(j['fields']['SOG'])
-                        r['COG'].append((ts, cog))
-                        r['SOG'].append((ts, sog))
+                        r['COG'].push(ts, cog)
+                        r['SOG'].push(ts, j['fields']['SOG']) # m/s
                     sampleCount += 1
 
             elif pgn == 130306:
                 #{"timestamp":"2019-10-20-19:04:58.009","prio":2,"src":9,"dst":255,"pgn":130306,"description":"Wind Data","fields":{"SID":0,"Wind Speed":7.18,"Wind Angle":281.8,"Reference":"Apparent"}}
-                aws = ms2kts(j['fields']['Wind Speed'])
-                awa = j['fields']['Wind Angle']
-                awa = awa if awa <= 180.0 else awa - 360.0
-                r['AWS'].append((ts, aws))
-                r['AWA'].append((ts, awa))
+                aws = j['fields']['Wind Speed'] # m/s
+                awa = j['fields']['Wind Angle'] # race_arrays converts to +/- 180
+                r['AWS'].push(ts, aws)
+                r['AWA'].push(ts, awa)
                 sampleCount += 1
 
             elif pgn == 127257:
                 # Attitude - pgn fields from analyzer are in degrees?
-                r['Yaw'].append((ts, j['fields']['Yaw']))
-                r['Pitch'].append((ts, j['fields']['Pitch']))
-                r['Roll'].append((ts, j['fields']['Roll']))
+                r['Yaw'].push(ts, j['fields']['Yaw'])
+                r['Pitch'].push(ts, j['fields']['Pitch'])
+                r['Roll'].push(ts, j['fields']['Roll'])
                 sampleCount += 1
             elif pgn == 127251:
                 # Rate of turn
-                r['ROT'].append((ts, j['fields']['Rate']))
+                r['ROT'].push(ts, j['fields']['Rate'])
                 sampleCount += 1
             elif pgn == 127252:
                 # Heave
-                r['Heave'].append((ts, j['fields']['Heave']))
+                r['Heave'].push(ts, j['fields']['Heave'])
                 sampleCount += 1
 
+    # N2K speeds are in meters/second - convert the samples to knots
+    for field in ['STW', 'SOG', 'AWS']:
+        r[field].v[:r[field].n] *= MS2KTS
+    # Freshly parsed, so parse_race caches the arrays once race_arrays has finished them
+    return(cachefile)
+
+def n2k_cache_params(r):
+    # Settings applied while parsing - if any of them change the cached arrays are stale
+    return([str(r['startts']), str(r['endts']), str(rudderCorrection), str(STWCorrection), str(LATLONSOURCE), str(COGSOGSOURCE)])
+
+def save_n2k_cache(fn, r):
+    arrays = { 'params': np.array(n2k_cache_params(r)), 'variation': np.array(r['variation']) }
+    for field in raceRawFields:
+        if field == 'LATLON':
+            arrays['LATLON_ts'] = r['LATLON']['ts']
+            arrays['LATLON_lat'] = r['LATLON']['lat']
+            arrays['LATLON_lon'] = r['LATLON']['lon']
+        else:
+            arrays[field + '_ts'] = r[field].ts
+            arrays[field + '_v'] = r[field].v
+    np.savez_compressed(fn, **arrays)
+
+def load_n2k_cache(fn, jsonfile, r):
+    if not os.path.isfile(fn) or os.path.getmtime(fn) < os.path.getmtime(jsonfile):
+        return(False)
+    with np.load(fn) as z:
+        if z['params'].tolist() != n2k_cache_params(r):
+            return(False)
+        r['variation'] = float(z['variation'])
+        for field in raceRawFields:
+            if field == 'LATLON':
+                r['LATLON'] = np.empty(len(z['LATLON_ts']), dtype=latlonDtype)
+                r['LATLON']['ts'] = z['LATLON_ts']
+                r['LATLON']['lat'] = z['LATLON_lat']
+                r['LATLON']['lon'] = z['LATLON_lon']
+            else:
+                r[field] = Channel(z[field + '_ts'].astype(np.int64), z[field + '_v'])
+    return(True)
+
 def parse_race_csv(regatta, r):
     # For now assume that CSV files are from Expedition
     # Expedition files start with '!Boat in the A0 cell followed by field names in B0-x0
@@ -589,14 +662,8 @@ def parse_race_csv(regatta, r):
         sentenceCount = 0
         lineNumber = 0
         expFields = {}
-        while True:
-            line = f.readline()
-            if not line:
-                break
-            # Strip off the trailing <LF>
-            if len(line) > 0:
-                line = line[:-1]
-
+        # Read the whole file at once rather than a line at a time
+        for line in f.read().splitlines():
             fields = line.split(',')
 
             if (fields[0] == "!Boat"):
@@ -656,12 +723,12 @@ def parse_race_csv(regatta, r):
 
             msDate = float(vals["Utc"])
             seconds = int((msDate  - 25569) * (86400))
-            ts = datetime.datetime.utcfromtimestamp(seconds)
-            #print("timestamp for %s (%d): %r" % (vals["Utc"], seconds, ts))
+            ts = seconds * 1000
+            #print("timestamp for %s (%d): %r" % (vals["Utc"], seconds, ms_datetime(ts)))
             
-            if (ts < r['startts']):
+            if (ts < r['startts_ms']):
                 continue;
-            if (ts >= r['endts']):
+            if (ts >= r['endts_ms']):
                 break;
             
             # LATLON
@@ -679,84 +746,152 @@ def parse_race_csv(regatta, r):
                 sampleCount += 1
                 
             if 'HDG' in vals:
-                r['HDG'].append((ts, vals['HDG']))
+                r['HDG'].push(ts, vals['HDG'])
                 sampleCount += 1
 
             if 'AWA' in vals:
-                r['AWA'].append((ts, vals['AWA']))
+                r['AWA'].push(ts, vals['AWA'])
                 sampleCount += 1
             
             if 'AWS' in vals:
-                r['AWS'].append((ts, vals['AWS']))
+                r['AWS'].push(ts, vals['AWS'])
                 sampleCount += 1
             
             if 'TWA' in vals:
-                r['TWA'].append((ts, vals['TWA']))
+                r['TWA'].push(ts, vals['TWA'])
                 sampleCount += 1
             
             if 'TWS' in vals:
-                r['TWS'].append((ts, vals['TWS']))
+                r['TWS'].push(ts, vals['TWS'])
                 sampleCount += 1
             
             if 'BSP' in vals:
-                r['STW'].append((ts, vals['BSP']))
+                r['STW'].push(ts, vals['BSP'])
                 sampleCount += 1
             
             if 'COG' in vals:
-                r['COG'].append((ts, vals['COG']))
+                r['COG'].push(ts, vals['COG'])
                 sampleCount += 1
             
             if 'SOG' in vals:
-                r['SOG'].append((ts, vals['SOG']))
+                r['SOG'].push(ts, vals['SOG'])
                 sampleCount += 1
             
             if 'Rudder' in vals:
-                r['RUD'].append((ts, vals['Rudder']))
+                r['RUD'].push(ts, vals['Rudder'])
                 sampleCount += 1
             
             if 'ROT' in vals:
-                r['ROT'].append((ts, vals['ROT']))
+                r['ROT'].push(ts, vals['ROT'])
                 sampleCount += 1
             
             lineNumber = lineNumber + 1                    
                 
     
+# A raw data field for a race - parallel arrays of sample timestamps and values
+# The parsers push samples into arrays that double in size when full; race_arrays trims them to length
+@dataclass
+class Channel:
+    ts: np.ndarray = None
+    v: np.ndarray = None
+    n: int = 0
+
+    def __post_init__(self):
+        if self.ts is None:
+            self.ts = np.empty(1024, dtype=np.int64)
+            self.v = np.empty(1024, dtype=np.float64)
+        else:
+            self.n = len(self.ts)
+
+    def __len__(self):
+        return(self.n)
+
+    def push(self, ts, v):
+        if self.n == len(self.ts):
+            self.ts = np.resize(self.ts, 2 * self.n)
+            self.v = np.resize(self.v, 2 * self.n)
+        self.ts[self.n] = ts
+        self.v[self.n] = v
+        self.n += 1
+
+    def trim(self):
+        self.ts = self.ts[:self.n]
+        self.v = self.v[:self.n]
+
+# Positions are one record per fix: epoch milliseconds, latitude, longitude
+latlonDtype = np.dtype([('ts', np.int64), ('lat', np.float64), ('lon', np.float64)])
+
+def race_arrays(r):
+    # Trim each raw field to the number of samples the parser pushed
+    # The parsers collect positions as (ts, lat, lon) tuples - make them one structured array
+    for field in raceRawFields:
+        if field == 'LATLON':
+            r['LATLON'] = np.array(r['LATLON'], dtype=latlonDtype)
+            continue
+        r[field].trim()
+    # Instruments report AWA as 0 - 360; make port negative over the whole array at once
+    r['AWA'].v = np.where(r['AWA'].v > 180.0, r['AWA'].v - 360.0, r['AWA'].v)
+
 def parse_race(regatta, r):
+    cachefile = None
     if r['data'][-5:] == '.nmea':
         parse_race_0183(regatta, r)
     elif r['data'][-4:] == '.log':
-        parse_race_n2k(regatta, r)
+        cachefile = parse_race_n2k(regatta, r)
     elif r['data'][-4:] == '.csv':
         parse_race_csv(regatta, r)
     else:
         print("Unknown NMEA format file %s" % (r['data']))
+    race_arrays(r)
+    if cachefile != None:
+        save_n2k_cache(cachefile, r)
 
 def analyze_race(regatta, r):
     # Find the start and end indices for each parameter on each leg
-    # This is a few more lines than using a list comprehension, but it's O(n) instead of O(n^2)
+    # The timestamps are sorted so a binary search finds each leg boundary
     for l in r['legs']:
         legInit(l)
 
+    # Every leg's start and end times, searched for in a single call per field
+    # Starts and ends are searched separately so overlapping or out of order legs get the right range
+    boundaries = np.array([l['startts_ms'] for l in r['legs']] + [l['endts_ms'] for l in r['legs']], dtype=np.int64)
+    legs = len(r['legs'])
+
     for field in legFields:
         if field == 'Time':
             continue
-        i = 0
-        for leg, l in enumerate(r['legs']):
-            if not field in r:
-                # Don't have this field in the raw data
+        if not field in r:
+            # Don't have this field in the raw data
+            for leg, l in enumerate(r['legs']):
                 l['sindex'][field] = 0
                 l['eindex'][field] = 0
                 print("## Leg %d No such field %s" % (leg, field))
-                break
-            while (i < len(r[field])) and (r[field][i][0] < l['startts']):
-                i += 1
-            l['sindex'][field] = i
-            while (i < len(r[field])) and (r[field][i][0] < l['endts']):
-                i += 1
+            continue
+        idx = np.searchsorted(r[field].ts, boundaries, side='left').tolist()
+        for leg, l in enumerate(r['legs']):
+            l['sindex'][field] = idx[leg]
             # Last data item for this leg
-            l['eindex'][field] = i
+            l['eindex'][field] = idx[legs + leg]
             #print("## Leg %d Field %s[%d:%d]" % (leg, f, l['sindex'][f], l['eindex'][f]))
 
+def bucket_means(ts, v, edges):
+    # Average the values whose timestamps fall in each bucket [edges[i], edges[i+1])
+    # Buckets without any data are NaN
+    idx = np.searchsorted(ts, edges)
+    counts = np.diff(idx)
+    means = np.full(len(counts), np.nan)
+    if idx[-1] > idx[0]:
+        # Pad with a zero so trailing empty buckets still have a valid reduceat index
+        seg = np.append(v[idx[0]:idx[-1]], 0.0)
+        sums = np.add.reduceat(seg, idx[:-1] - idx[0])
+        np.divide(sums, counts, out=means, where=counts > 0)
+    return(means)
+
+def bucket_angle_means(ts, v, edges):
+    # Circular mean of the angles (in degrees) in each bucket, in the range [0, 360)
+    a = np.radians(v)
+    return(np.degrees(np.arctan2(bucket_means(ts, np.sin(a), edges), bucket_means(ts, np.cos(a), edges))) % 360.0)
+
 def analyze_leg(regatta, r, leg):
     # Coalesce the data from each leg into a list of 10 second samples
     # Compute the TWS, TWD, and TWA for each sample
@@ -768,236 +903,225 @@ def analyze_leg(regatta, r, leg):
 
     # Chop the leg into 10 second buckets
     # Look for tacks and gybes
-    bucketDelta = datetime.timedelta(seconds=sampleSeconds)
-    bucketStart = l['startts']
-
-    index = {}
-    for field in ['AWA', 'AWS', 'STW', 'SOG', 'RUD', 'TWS', 'COG', 'HDG', 'TWD', 'Pitch', 'Roll', 'ROT', 'Heave']:
-        index[field] = l['sindex'][field]
-    
-    l['samples'] = []
-    while bucketStart < l['endts']:
-        bucket = {}
-        bucketEnd = bucketStart + bucketDelta
-        bucketEnd = min(bucketEnd, l['endts'])
-        bucket['ts'] = bucketStart
-
-        # Fields that can be a simple per bucket average
-        for field in ['AWA', 'AWS', 'STW', 'SOG', 'RUD', 'TWS', 'Pitch', 'Roll', 'ROT', 'Heave']:
-            total = 0.0
-            count = 0
-            # Advance to the beginning of the run of data for this bucket
-            while index[field] < l['eindex'][field] and r[field][index[field]][0] < bucketStart:
-                index[field] += 1
-            # Run through the valid data summing the value
-            while index[field] < l['eindex'][field] and r[field][index[field]][0] < bucketEnd:
-                d = r[field][index[field]]
-                #if len(d) < 2:
-                #    print("Field %s data element too small: %r" % (field, d))
-                total += d[1]
-                count += 1
-                index[field] += 1
-            # Take the average for the bucket
-            bucket[field] = None if count == 0 else total / count
-        
-        markBearing = c["legs"][leg]["bearing"]
-        # If we're going north-ish, convert COG and Heading ranges to [-180, 180] in case some samples straddle due north
-        # This is to catch the "averaging samples around due north degress leads to due south" problem - mean([0,359.999]) = 180
-        for field in ['COG', 'HDG', 'TWD']:
-            total = 0.0
-            count = 0
-            # Advance to the beginning of the run of data for this bucket
-            while index[field] < l['eindex'][field] and r[field][index[field]][0] < bucketStart:
-                index[field] += 1
-            while index[field] < l['eindex'][field] and r[field][index[field]][0] < bucketEnd:
-                d = r[field][index[field]]
-                # If we're going north-ish, convert COG and Heading ranges to [-180, 180] in case some samples straddle due north
-                total += d[1] if (markBearing > 90 and markBearing < 270) or (d[1] <= 180) else d[1] - 360.0
-                count += 1
-                index[field] += 1
-            if count == 0:
-                bucket[field] = None
-            else:
-                bucket[field] = total / count
-                bucket[field] += 0.0 if (markBearing > 90 and markBearing < 270) or (bucket[field] > 0) else 360.0 # Convert back to 0 - 360 if needed
-        
-        """
-        Compute TWS and TWD for this bucket
-
-        AWA = + for Starboard, – for Port
-        AWD = H + AWA ( 0 < AWD < 360 )
-        u = SOG * Sin (COG) – AWS * Sin (AWD)
-        v = SOG * Cos (COG) – AWS * Cos (AWD)
-        TWS = SQRT ( u*u + v*v )
-        TWD = ATAN ( u / v )
-        """
-
-        if bucket['HDG'] == None or bucket['COG'] == None or bucket['SOG'] == None or bucket['AWA'] == None or bucket['AWS'] == None:
-            # Can't compute True Wind w/o HDG, COG, SOG and AWA, AWS
-            bucket['TWD'] = None
-            bucket['TWS'] = None
-            bucket['TWA'] = None
-        else:
-            hdg = radians(bucket['HDG'])
-            aws = bucket['AWS']
-            awa = radians(bucket['AWA'])
-            cog = radians(bucket['COG'])
-            sog = bucket['SOG']
-
-            # Compute TWD, TWS if it's not done by the instruments
-            if bucket['TWD'] == None:
-                awd = fmod(hdg + awa, tau) # Compensate for boat's heading
-                u = (sog * cos(cog)) - (aws * cos(awd))
-                v = (sog * sin(cog)) - (aws * sin(awd))
-                tws = sqrt((u*u) + (v*v))
-                # Now we want to know where it's from, not where it's going, so add pi
-                twd = degrees(fmod(atan2(v,u)+pi, tau))
-
-                bucket['TWS'] = tws
-                bucket['TWD'] = twd
-
-            # Compute TWA from TWD and Heading
-            twa = fmod((bucket['TWD'] - bucket['HDG']) + 360.0, 360.0)
-            bucket['TWA'] = twa
-        
-        bucketStart = bucketEnd
-        for key, value in bucket.items():
-            # Make sure there's at least one valid data item for this bucket
-            if key != 'ts' and value != None:
-                l['samples'].append(bucket) # add this data item to the list of samples
-                continue
-
-    print("## analyze_race %s Leg %d samples %d" % (r['race'], leg+1, len(l['samples'])))
-
-def average_sample_fields(samples, markBearing):
-    avg_fields = ['AWA', 'AWS', 'STW', 'RUD', 'SOG', 'TWS', 'COG', 'HDG', 'TWD', 'TWA']
+    edges = np.append(np.arange(l['startts_ms'], l['endts_ms'], sampleSeconds * 1000), l['endts_ms'])
+
+    means = {}
+    # Fields that can be a simple per bucket average
+    for field in ['AWA', 'AWS', 'STW', 'SOG', 'RUD', 'TWS', 'Pitch', 'Roll', 'ROT', 'Heave']:
+        ts = r[field].ts[l['sindex'][field]:l['eindex'][field]]
+        v = r[field].v[l['sindex'][field]:l['eindex'][field]]
+        means[field] = bucket_means(ts, v, edges)
+
+    # Average the angles on the unit circle so samples straddling due north don't average to due south
+    for field in ['COG', 'HDG', 'TWD']:
+        ts = r[field].ts[l['sindex'][field]:l['eindex'][field]]
+        v = r[field].v[l['sindex'][field]:l['eindex'][field]]
+        means[field] = bucket_angle_means(ts, v, edges)
+
+    """
+    Compute TWS and TWD for every bucket at once
+
+    AWA = + for Starboard, – for Port
+    AWD = H + AWA ( 0 < AWD < 360 )
+    u = SOG * Sin (COG) – AWS * Sin (AWD)
+    v = SOG * Cos (COG) – AWS * Cos (AWD)
+    TWS = SQRT ( u*u + v*v )
+    TWD = ATAN ( u / v )
+    """
+
+    # Can't compute True Wind w/o HDG, COG, SOG and AWA, AWS
+    valid = ~(np.isnan(means['HDG']) | np.isnan(means['COG']) | np.isnan(means['SOG']) | np.isnan(means['AWA']) | np.isnan(means['AWS']))
+    hdg = np.radians(means['HDG'])
+    awa = np.radians(means['AWA'])
+    cog = np.radians(means['COG'])
+    awd = np.fmod(hdg + awa, tau) # Compensate for boat's heading
+    u = (means['SOG'] * np.cos(cog)) - (means['AWS'] * np.cos(awd))
+    v = (means['SOG'] * np.sin(cog)) - (means['AWS'] * np.sin(awd))
+    tws = np.hypot(u, v)
+    # Now we want to know where it's from, not where it's going, so add pi
+    twd = np.degrees(np.fmod(np.arctan2(v, u) + pi, tau))
+
+    # Compute TWD, TWS if it's not done by the instruments
+    computed = np.isnan(means['TWD'])
+    means['TWS'] = np.where(valid, np.where(computed, tws, means['TWS']), np.nan)
+    means['TWD'] = np.where(valid, np.where(computed, twd, means['TWD']), np.nan)
+    # Compute TWA from TWD and Heading
+    means['TWA'] = np.fmod((means['TWD'] - means['HDG']) + 360.0, 360.0)
+
+    # Make sure there's at least one valid data item for each bucket we keep
+    keep = np.zeros(len(edges) - 1, dtype=bool)
+    for field in means:
+        keep |= ~np.isnan(means[field])
+
+    # Each field's kept buckets as its own contiguous float64 array, NaN where a field has no data
+    # Filters and plots can use these directly - a structured array column is a strided view they would copy
+    l['bucket'] = {}
+    for field in means:
+        l['bucket'][field] = means[field][keep]
+
+    # One row per bucket
+    l['samples_array'] = np.empty(np.count_nonzero(keep), dtype=[('ts', 'datetime64[ms]')] + [(field, np.float64) for field in means])
+    l['samples_array']['ts'] = edges[:-1][keep].astype('datetime64[ms]')
+    for field in means:
+        l['samples_array'][field] = l['bucket'][field]
+
+    print("## analyze_race %s Leg %d samples %d" % (r['race'], leg+1, len(l['samples_array'])))
+
+linearFields = ['AWA', 'AWS', 'STW', 'RUD', 'SOG', 'TWS']
+angleFields = ['COG', 'HDG', 'TWD', 'TWA']
+
+def running_sums(a):
+    # Running sum of the valid (non-NaN) values and a running count of them, both starting at 0
+    # The sum over a[lo:hi] is then cs[hi] - cs[lo]
+    valid = ~np.isnan(a)
+    cs = np.concatenate(([0.0], np.cumsum(np.where(valid, a, 0.0))))
+    cc = np.concatenate(([0], np.cumsum(valid)))
+    return(cs, cc)
+
+def sample_sums(samples):
+    # samples is a leg's samples_array
+    # Angles are summed as unit vectors so their averages are circular means
+    sums = {}
+    for field in linearFields:
+        sums[field] = running_sums(samples[field])
+    for field in angleFields:
+        rad = np.radians(samples[field])
+        sin, cc = running_sums(np.sin(rad))
+        cos, cc = running_sums(np.cos(rad))
+        sums[field] = (sin, cos, cc)
+    return(sums)
+
+def average_sample_fields(sums, lo, hi):
+    # Average each field over samples [lo, hi) from the leg's running sums
+    # Fields with no valid samples in the range are None
     d = {}
-    counts = {}
-    for field in avg_fields:
-        d[field] = None
-        counts[field] = 0
-
-    for s in samples:
-        for field in ['AWA', 'AWS', 'STW', 'RUD', 'SOG', 'TWS']:
-            if s[field] != None:
-                d[field] = s[field] if d[field] == None else d[field] + s[field]
-                counts[field] += 1
-        for field in ['COG', 'HDG', 'TWD', 'TWA']:
-            if s[field] != None:
-                # If course is biased north change range to [-180, 180]
-                angle = s[field] if (markBearing >= 90 and markBearing <= 270) or (s[field] <= 180) else s[field] - 360
-                d[field] = angle if d[field] == None else d[field] + angle
-                counts[field] += 1
-    for field in ['AWA', 'AWS', 'STW', 'RUD', 'SOG', 'TWS']:
-        if d[field] != None:
-            d[field] /= len(samples)
-    for field in ['COG', 'HDG', 'TWD', 'TWA']:
-        if d[field] != None:
-            d[field] /= len(samples)
-            d[field] += 0.0 if d[field] > 0 else 360.0 # Convert back to 0-360
+    for field in linearFields:
+        cs, cc = sums[field]
+        n = cc[hi] - cc[lo]
+        d[field] = None if n == 0 else float((cs[hi] - cs[lo]) / n)
+    for field in angleFields:
+        sin, cos, cc = sums[field]
+        if cc[hi] - cc[lo] == 0:
+            d[field] = None
+        else:
+            d[field] = float(np.degrees(np.arctan2(sin[hi] - sin[lo], cos[hi] - cos[lo])) % 360.0)
     # Don't return a data bucket unless it has at least one valid data point
-    for field in avg_fields:
+    for field in d:
         if d[field] != None:
             return(d)
     print("## average_sample_fields no data")
     return(None)
 
-@dataclass
 class LegItem:
-    t: str = None
-    comment: str = None
-    start: datetime.datetime = None
-    end: datetime.datetime = None
-    duration: datetime.timedelta = None
-    board: str = None
-    hdg: float = None
-    awa: float = None
-    aws: float = None
-    stw: float = None
-    cog: float = None
-    sog: float = None
-    rud: float = None
-    tws: float = None
-    twd: float = None
-    twa: float = None
+    # One report line - a comment, or a minute, board, or leg summary
+    # __slots__ keeps the many instances small; written out by hand since dataclass(slots=True) needs Python 3.10
+    __slots__ = ('t', 'comment', 'start', 'end', 'duration', 'board', 'hdg', 'awa', 'aws', 'stw', 'cog', 'sog', 'rud', 'tws', 'twd', 'twa',
+                 'start_str', 'end_str')
+
+    def __init__(self, t=None, comment=None, start=None, end=None, duration=None, board=None,
+                 hdg=None, awa=None, aws=None, stw=None, cog=None, sog=None, rud=None, tws=None, twd=None, twa=None):
+        self.t = t
+        self.comment = comment
+        self.start = start
+        self.end = end
+        self.duration = duration
+        self.board = board
+        self.hdg = hdg
+        self.awa = awa
+        self.aws = aws
+        self.stw = stw
+        self.cog = cog
+        self.sog = sog
+        self.rud = rud
+        self.tws = tws
+        self.twd = twd
+        self.twa = twa
+        # Format the local start and end times once for all of the reports
+        self.start_str = None if start == None else local_time(start, tzoffset)
+        self.end_str = None if end == None else local_time(end, tzoffset)
+
+def segment_boards(awa, ts, legStart):
+    # Split a leg into boards (tacks or gybes) from the sign of the AWA of each sample
+    # Returns a list of (start, end, 'Port' or 'Stbd')
+    # Only samples that aren't near a tack or gybe count; a board ends at the last of them before the AWA changes sign
+    missing = np.count_nonzero(np.isnan(awa[1:]))
+    if missing > 0:
+        print("AWA is none for %d of %d legSamples" % (missing, len(awa)))
+    with np.errstate(invalid='ignore'):
+        used = np.nonzero((np.abs(awa) > minAWA) & (np.abs(awa) < maxAWA))[0]
+    used = used[used > 0]
+    port = awa[used] < 0
+    # The first sample picks the starting board even if it's mid tack
+    changes = np.nonzero(port != np.append(awa[0] < 0, port[:-1]))[0]
+
+    times = ts[used].tolist()
+    starts = [legStart] + [times[i] for i in changes]
+    ends = [legStart if i == 0 else times[i-1] for i in changes] + [times[-1] if len(times) > 0 else legStart]
+    sides = [awa[0] < 0] + [port[i] for i in changes]
+    return([(start, end, 'Port' if side else 'Stbd') for start, end, side in zip(starts, ends, sides)])
 
 # Return a list of analysis items. Each item can be a comment or a line of data.
 # Data lines can be a minute, a board summary, or a leg summary
 def analyze_by_minute(regatta, r):
+    # The text and spreadsheet reports both want the same items, so only build them once per race
+    if 'items' in r:
+        return(r['items'])
     items = []
     c = regatta['courses'][r['course']]
     
     items.append(LegItem(t="Regatta", comment="%s - %s - %d race%s" % (regatta['boat'], regatta['regatta'], len(regatta['races']), "" if len(regatta['races']) < 2 else "s")))
     for leg, l in enumerate(r['legs']):
-        markBearing = c["legs"][leg]["bearing"]
+        cl = c["legs"][leg]
         items.append(LegItem(t="Leg", comment="Race %s Course %s Leg %d %s (%.2fnm @ %03d%s)" %
-                             (r['race'], r['course'], leg+1, c["legs"][leg]["label"], c["legs"][leg]["distance"], markBearing, deg)))
+                             (r['race'], r['course'], leg+1, cl["label"], cl["distance"], cl["bearing"], deg)))
 
     items.append(LegItem(t="Blank"))
     for leg, l in enumerate(r['legs']):
         legStart = l['startts']
         legEnd = l['endts']
-        markBearing = c["legs"][leg]["bearing"]
+        cl = c["legs"][leg]
 
         items.append(LegItem(t="Leg", comment="Race %s Leg %d %s (%.2fnm @ %03d%s) - (%s - %s) %s" %
-                             (r['race'], leg+1, c["legs"][leg]["label"], c["legs"][leg]["distance"], markBearing, deg, addtz(legStart)[11:], addtz(legEnd)[11:], l['duration'])))
+                             (r['race'], leg+1, cl["label"], cl["distance"], cl["bearing"], deg, local_time(legStart, tzoffset), local_time(legEnd, tzoffset), l['duration'])))
         
-        legSamples = l['samples']
-        if legSamples[0]['AWA'] == None:
+        legSamples = l['samples_array']
+        legTimes = legSamples['ts']
+        # Minutes, boards, and the leg all average slices of the same samples, so sum them once
+        legSums = sample_sums(legSamples)
+        if np.isnan(legSamples['AWA'][0]):
             print("## No AWA at start of leg %s %r" % (addtz(legStart)[11:0], legSamples[0]))
-        board = 'Port' if legSamples[0]['AWA'] < 0 else 'Stbd'
-        # Loop through the AWAs looking for tacks and gybes
-        l['boards'] = []
-        bstart = l['startts']
-        bend =  l['startts']
-        for i in range(1, len(legSamples)):
-            awa = legSamples[i]['AWA']
-
-            if awa is None:
-                print("AWA is none for leg sample %d of %d legSamples" % (i, len(legSamples)))
-                continue
-                
-            # Use sample if not near a tack or gybe
-            if abs(awa) > minAWA and abs(awa) < maxAWA:
-                samplets = legSamples[i]['ts']
-                if (board == 'Stbd' and awa < 0) or (board == 'Port' and awa > 0):
-                    l['boards'].append((bstart, bend, board))
-                    board = 'Port' if awa < 0 else 'Stbd'
-                    #print("New board %s (%3f) @ %s" % (board, awa, samplets))
-                    bstart = samplets
-                bend = samplets # extend end timestamp to current sample - but not if tacking or gybing
-
-        # Last board for this leg
-        l['boards'].append((bstart, bend, board))
+        l['boards'] = segment_boards(legSamples['AWA'], legTimes, l['startts'])
     
         print("## analyze_by_minute Leg %d %s #boards %d" % (leg, l['boards'][0][1], len(l['boards'])))
         
-        bucketDelta = datetime.timedelta(seconds=reportSeconds)
+        bucketDelta = np.timedelta64(reportSeconds, 's')
+        # The samples are sorted by time so each board is a slice - find them all with one search
+        # Time range is start to end (not > start) since boardStart includes waiting for tack or gybe to finish
+        boardLo = np.searchsorted(legTimes, np.array([board[0] for board in l['boards']], dtype='datetime64[ms]'), side='left')
+        boardHi = np.searchsorted(legTimes, np.array([board[1] for board in l['boards']], dtype='datetime64[ms]'), side='right')
         for b in range(len(l['boards'])):
             boardStart = l['boards'][b][0]
             boardEnd = l['boards'][b][1]
-            items.append(LegItem(t="Board", comment="Race %s Leg %d Board %d @ %s - %s %s" % (r['race'], leg+1, b+1, addtz(boardStart)[11:], addtz(boardEnd)[11:], boardEnd - boardStart)))
-
-            # Time range is start to end (not > start) since boardStart includes waiting for tack or gybe to finish
-            boardSamples = [ s for s in legSamples if s['ts'] >= boardStart and s['ts'] <= boardEnd ]
-            minute = {}
-            bucketStart = boardStart
-            while bucketStart < boardEnd:
-                # Per-minute
-                bucketEnd = bucketStart + bucketDelta
-                bucketEnd = min(bucketEnd, boardEnd)
-                bucketSamples = [ s for s in boardSamples if s['ts'] > bucketStart and s['ts'] <= bucketEnd ]
-                savg = average_sample_fields(bucketSamples, markBearing)
+            items.append(LegItem(t="Board", comment="Race %s Leg %d Board %d @ %s - %s %s" % (r['race'], leg+1, b+1, local_time(boardStart, tzoffset), local_time(boardEnd, tzoffset), boardEnd - boardStart)))
+
+            boardSamples = legSamples[boardLo[b]:boardHi[b]]
+            # Per-minute - each minute is (start, end], so searching for the minute edges splits the board's samples
+            edges = np.append(np.arange(np.datetime64(boardStart, 'ms'), np.datetime64(boardEnd, 'ms'), bucketDelta), np.datetime64(boardEnd, 'ms'))
+            idx = np.searchsorted(legTimes[boardLo[b]:boardHi[b]], edges, side='right')
+            edgeTimes = edges.tolist()
+            for m in range(len(edges) - 1):
+                bucketStart = edgeTimes[m]
+                bucketEnd = edgeTimes[m+1]
+                savg = average_sample_fields(legSums, boardLo[b] + idx[m], boardLo[b] + idx[m+1])
                 if savg != None:
                     items.append(LegItem("Minute", None, bucketStart, bucketEnd, None, l['boards'][b][2], savg['HDG'], savg['AWA'], savg['AWS'], savg['STW'], savg['COG'], savg['SOG'], savg['RUD'], savg['TWS'], savg['TWD'], savg['TWA']))
-                bucketStart = bucketEnd
                     
             # Per-board
             if len(boardSamples) == 0:
                 items.append(LegItem(t="Board", comment=("Board %s - %s %s - no samples" %
-                                      (addtz(boardStart)[11:], addtz(boardEnd)[11:], boardEnd - boardStart))))
+                                      (local_time(boardStart, tzoffset), local_time(boardEnd, tzoffset), boardEnd - boardStart))))
             else:
-                savg = average_sample_fields(boardSamples, markBearing)
+                savg = average_sample_fields(legSums, boardLo[b], boardHi[b])
                 if savg != None:
                     items.append(LegItem("Board", None, boardStart, boardEnd, boardEnd - boardStart, l['boards'][b][2], savg['HDG'], savg['AWA'], savg['AWS'], savg['STW'], savg['COG'], savg['SOG'], savg['RUD'], savg['TWS'], savg['TWD'], savg['TWA']))
 
@@ -1007,13 +1131,41 @@ def analyze_by_minute(regatta, r):
         # Per-leg
         if len(legSamples) == 0:
             items.append(LegItem(t="Leg", comment=("Leg   %s - %s %s - no samples" %
-                                                   (addtz(boardStart)[11:], addtz(boardEnd)[11:], boardEnd - boardStart))))
+                                                   (local_time(boardStart, tzoffset), local_time(boardEnd, tzoffset), boardEnd - boardStart))))
         else:
-            savg = average_sample_fields(legSamples, markBearing)
+            savg = average_sample_fields(legSums, 0, len(legSamples))
             items.append(LegItem("Leg", None, legStart, legEnd, legEnd - legStart, None, savg['HDG'], savg['AWA'], savg['AWS'], savg['STW'], savg['COG'], savg['SOG'], savg['RUD'], savg['TWS'], savg['TWD'], savg['TWA']))
         items.append(LegItem("Blank"))
+    r['items'] = items
     return(items)
 
+def race_items_worker(regatta, r):
+    # Build one race's report items in a worker process and hand the race back
+    # Workers don't share our globals so set this regatta's time zone first
+    regatta_settings(regatta)
+    analyze_by_minute(regatta, r)
+    return(r)
+
+def race_items(races):
+    # Each race's report items are independent, so build the ones not already done in parallel
+    # races is a list of (regatta, race) pairs
+    todo = [(regatta, r) for regatta, r in races if not 'items' in r]
+    if len(todo) < 2:
+        for regatta, r in todo:
+            regatta_settings(regatta)
+            analyze_by_minute(regatta, r)
+        return
+    # Only send the workers what analyze_by_minute uses, not every race's raw data
+    regattaArgs = [dict(regatta, races=[None] * len(regatta['races'])) for regatta, r in todo]
+    raceArgs = [{'race': r['race'], 'course': r['course'],
+                 'legs': [{k: l[k] for k in ('startts', 'endts', 'duration', 'samples_array')} for l in r['legs']]} for regatta, r in todo]
+    with concurrent.futures.ProcessPoolExecutor() as pool:
+        results = pool.map(race_items_worker, regattaArgs, raceArgs)
+        for (regatta, r), built in zip(todo, results):
+            r['items'] = built['items']
+            for l, bl in zip(r['legs'], built['legs']):
+                l['boards'] = bl['boards']
+
 @dataclass
 class XlsxFormats:
     degree3 = None
@@ -1039,6 +1191,7 @@ def per_race_xlsx(xl, regatta, r):
         if f != None:
             ws.set_column(col, col, None, f)
     
+    oneDay = datetime.timedelta(days=1)
     row = 0
     column_labels = [ None, "Start", "End", "Duration", "Board", "HDG", "AWA", "AWS", "STW", "COG", "SOG", "RUD", "TWS", "TWD", "TWA" ]
     ws.set_row(row, None, xlsxF.header)
@@ -1051,25 +1204,36 @@ def per_race_xlsx(xl, regatta, r):
             if i.comment != None:
                 ws.write_row(row, 0, [i.t, i.comment])
             else:
-                ws.write_row(row, 0, [i.t, addtz(i.start)[11:], addtz(i.end)[11:], i.end - i.start if (i.t == "Board") or (i.t == "Leg") else None, i.board if i.t == "Minute" else None,
+                # Durations go in as Excel day fractions so xlsxwriter doesn't have to work out the type of each cell
+                ws.write_row(row, 0, [i.t, i.start_str, i.end_str, (i.end - i.start) / oneDay if (i.t == "Board") or (i.t == "Leg") else None, i.board if i.t == "Minute" else None,
                                       i.hdg, i.awa, i.aws, i.stw, i.cog, i.sog, i.rud, i.tws, i.twd, i.twa])
                 if i.hdg == None and i.t == "Minute":
-                    print("## %s HDG None" % (addtz(i.start)[11:]))
+                    print("## %s HDG None" % (i.start_str))
             row += 1
         elif i.t == "Blank":
             row += 1
 
     # Create the conditional highlighting for the regatta, leg, and board summary lines
-    # I don't understand why we need the INDIRECT() call
-    ws.conditional_format(0, 0, row, last_col, {'type': 'formula', 'criteria': '=INDIRECT("A"&ROW())="Regatta"', 'format': xlsxF.regatta})
-    ws.conditional_format(0, 0, row, last_col, {'type': 'formula', 'criteria': '=INDIRECT("A"&ROW())="Leg"', 'format': xlsxF.leg})
-    ws.conditional_format(0, 0, row, last_col, {'type': 'formula', 'criteria': '=INDIRECT("A"&ROW())="Board"', 'format': xlsxF.board})
+    # The formula is relative to the range's top left cell: the column is pinned to A and the row follows each cell
+    # (INDIRECT() did the same but is volatile, so Excel recalculated it on every change)
+    ws.conditional_format(0, 0, row, last_col, {'type': 'formula', 'criteria': '=$A1="Regatta"', 'format': xlsxF.regatta})
+    ws.conditional_format(0, 0, row, last_col, {'type': 'formula', 'criteria': '=$A1="Leg"', 'format': xlsxF.leg})
+    ws.conditional_format(0, 0, row, last_col, {'type': 'formula', 'criteria': '=$A1="Board"', 'format': xlsxF.board})
+
+def aggregate_base():
+    # Start of the file name for outputs covering every regatta in the run
+    bn = regattas[regattalist[0]]['boat']
+    return("%s_%s" % (bn, "aggregate" if len(regattalist) > 1 else regattas[regattalist[0]]['basefn']))
 
 def spreadsheet_report():
-    bn = regattas[regattalist[0]]['boat']
-    xlfn = "%s_%s.xlsx" % (bn, "aggregate" if len(regattalist) > 1 else regattas[regattalist[0]]['basefn'])
+    xlfn = aggregate_base() + ".xlsx"
 
-    with xlsxwriter.Workbook(xlfn) as xl:
+    # Only load the spreadsheet writer when a spreadsheet is asked for - it's a slow import,
+    # and the race parsing worker processes never need it
+    import xlsxwriter
+
+    # The rows are written in order, so stream them to disk instead of keeping every sheet in memory
+    with xlsxwriter.Workbook(xlfn, {'constant_memory': True}) as xl:
         xlsxF.degree3 = xl.add_format({'num_format': '000'})
         xlsxF.float0 = xl.add_format({'num_format': '##0'})
         xlsxF.float1 = xl.add_format({'num_format': '##0.0'})
@@ -1083,10 +1247,11 @@ def spreadsheet_report():
         xlsxF.leg = xl.add_format({'bold': True, 'bg_color': '#E2F0CB'}) # Green-ish
         xlsxF.board = xl.add_format({'bg_color': '#C7CEEA'}) # Blue-ish
 
-        for rn in regattalist:
-            reg = regattas[rn]
-            for r in reg['races']:
-                per_race_xlsx(xl, reg, r)
+        # Build the races' items in parallel, then write the worksheets one at a time
+        races = [(regattas[rn], r) for rn in regattalist for r in regattas[rn]['races']]
+        race_items(races)
+        for reg, r in races:
+            per_race_xlsx(xl, reg, r)
 
 def none_sub(v, f):
     # this is a kludgey way of returning a string the length of the format with a - at the end
@@ -1095,8 +1260,21 @@ def none_sub(v, f):
         return(f % (v))
     return(tmp[-int(f[1]):])
 
+# Per-leg report columns: LegItem attribute, format, and the dash printed when there's no data
+legReportFields = [(n, f, none_sub(None, f)) for n, f in
+                   [('hdg', "%3.0f"), ('awa', "%4.0f"), ('aws', "%4.1f"), ('stw', "%4.1f"), ('cog', "%3.0f"),
+                    ('sog', "%4.1f"), ('rud', "%5.1f"), ('tws', "%4.1f"), ('twd', "%4.0f"), ('twa', "%4.0f")]]
+legReportValues = "HDG %s AWA %s AWS %s STW %s COG %s SOG %s RUD %s TWS %s TWD %s TWA %s\n"
+
+def leg_report_values(i):
+    vals = []
+    for n, f, dash in legReportFields:
+        v = getattr(i, n)
+        vals.append(dash if v == None else f % (v))
+    return(legReportValues % tuple(vals))
+
 def per_leg_report(regatta, r):
-    ofn = "%s_%s_%s_legs.txt" % (regatta['boat'], regatta['basefn'], r['race'])
+    ofn = r['outbase'] + "_legs.txt"
     print("## Create %s" % (ofn))
 
     items = analyze_by_minute(regatta, r)
@@ -1109,23 +1287,10 @@ def per_leg_report(regatta, r):
                     f.write("%s\n" % (i.comment))
                 elif i.t == "Leg" or i.t == "Board":
                     #f.write("%6s %s - %s %8s HDG %3.0f AWA %4.0f AWS %4.1f STW %4.1f COG %3.0f SOG %4.1f RUD %5.1f TWS %4.1f TWD %4.0f TWA %4.0f\n" %
-                    f.write("%6s %s - %s %8s HDG %s AWA %s AWS %s STW %s COG %s SOG %s RUD %s TWS %s TWD %s TWA %s\n" %
-                            (i.t, addtz(i.start)[11:], addtz(i.end)[11:], i.end - i.start,
-                             none_sub(i.hdg, "%3.0f"), none_sub(i.awa, "%4.0f"), none_sub(i.aws, "%4.1f"), none_sub(i.stw, "%4.1f"), none_sub(i.cog, "%3.0f"), none_sub(i.sog, "%4.1f"), none_sub(i.rud, "%5.1f"), none_sub(i.tws, "%4.1f"), none_sub(i.twd, "%4.0f"), none_sub(i.twa, "%4.0f")))
+                    f.write("%6s %s - %s %8s %s" % (i.t, i.start_str, i.end_str, i.end - i.start, leg_report_values(i)))
                 elif i.t == "Minute":
                     #f.write("Minute %s - %s     %s HDG %3.0f AWA %4.0f AWS %4.1f STW %4.1f COG %3.0f SOG %4.1f RUD %5.1f TWS %4.1f TWD %4.0f TWA %4.0f\n" %
-                    f.write("Minute %s - %s     %s HDG %s AWA %s AWS %s STW %s COG %s SOG %s RUD %s TWS %s TWD %s TWA %s\n" %
-                            (addtz(i.start)[11:], addtz(i.end)[11:], i.board,
-                             none_sub(i.hdg, "%3.0f"),
-                             none_sub(i.awa, "%4.0f"),
-                             none_sub(i.aws, "%4.1f"),
-                             none_sub(i.stw, "%4.1f"),
-                             none_sub(i.cog, "%3.0f"),
-                             none_sub(i.sog, "%4.1f"),
-                             none_sub(i.rud, "%5.1f"),
-                             none_sub(i.tws, "%4.1f"),
-                             none_sub(i.twd, "%4.0f"),
-                             none_sub(i.twa, "%4.0f")))
+                    f.write("Minute %s - %s     %s %s" % (i.start_str, i.end_str, i.board, leg_report_values(i)))
                 elif i.t == "Blank":
                     f.write("\n")
 
@@ -1136,36 +1301,32 @@ maxLegDuration = 0
 maxPlotHeight = 3.0
 maxPlotWidth = 10.0
 
-def leg_chart(regatta, r, leg, fig, ax):
-    y_scales = {}
-    y_scales["compass"] = {"in_use": False, "min": 0, "max": 360, "label": ""}
-    y_scales["apparent"] = {"in_use": False, "min": -180, "max": 180, "label": ""}
-    y_scales["windspeed"] = {"in_use": False, "min": 0, "max": 25, "label": ""}
-    y_scales["boatspeed"] = {"in_use": False, "min": 0, "max": 12, "label": ""}
-    y_scales["rudder"] = {"in_use": False, "min": -20, "max": 20, "label": ""}
-
-    plotItems = {}
-    plotItems['COG'] = { 'label': 'COG', 'scale': 'compass', 'color': 'black', 'style': '-' }
-    plotItems['SOG'] = { 'label': 'SOG', 'scale': 'boatspeed', 'color': 'black', 'style': '-' }
-    plotItems['TWD'] = { 'label': 'TWD', 'scale': 'compass', 'color': cmap[0], 'style': '--' }
-    plotItems['TWS'] = { 'label': 'TWS', 'scale': 'windspeed', 'color': cmap[0], 'style': '-' }
-    plotItems['AWA'] = { 'label': 'AWA', 'scale': 'apparent', 'color': cmap[1], 'style': '-' }
-    plotItems['AWS'] = { 'label': 'AWS', 'scale': 'windspeed', 'color': cmap[1], 'style': '--' }
-    plotItems['HDG'] = { 'label': 'HDG', 'scale': 'compass', 'color': cmap[4], 'style': '-' }
-    plotItems['STW'] = { 'label': 'STW', 'scale': 'boatspeed', 'color': cmap[2], 'style': '-' }
-    plotItems['RUD'] = { 'label': 'Rudder', 'scale': 'rudder', 'color': cmap[3], 'style': ':' }
-    plotItems['Roll'] = { 'label': 'Heel', 'scale': 'rudder', 'color': cmap[3], 'style': '-' }
+# Strip chart y axis ranges - the extra axes are laid out in this order
+stripScales = {"compass": (0, 360), "apparent": (-180, 180), "windspeed": (0, 25), "boatspeed": (0, 12), "rudder": (-20, 20)}
+
+stripItems = {}
+stripItems['COG'] = { 'label': 'COG', 'scale': 'compass', 'color': 'black', 'style': '-' }
+stripItems['SOG'] = { 'label': 'SOG', 'scale': 'boatspeed', 'color': 'black', 'style': '-' }
+stripItems['TWD'] = { 'label': 'TWD', 'scale': 'compass', 'color': cmap[0], 'style': '--' }
+stripItems['TWS'] = { 'label': 'TWS', 'scale': 'windspeed', 'color': cmap[0], 'style': '-' }
+stripItems['AWA'] = { 'label': 'AWA', 'scale': 'apparent', 'color': cmap[1], 'style': '-' }
+stripItems['AWS'] = { 'label': 'AWS', 'scale': 'windspeed', 'color': cmap[1], 'style': '--' }
+stripItems['HDG'] = { 'label': 'HDG', 'scale': 'compass', 'color': cmap[4], 'style': '-' }
+stripItems['STW'] = { 'label': 'STW', 'scale': 'boatspeed', 'color': cmap[2], 'style': '-' }
+stripItems['RUD'] = { 'label': 'Rudder', 'scale': 'rudder', 'color': cmap[3], 'style': ':' }
+stripItems['Roll'] = { 'label': 'Heel', 'scale': 'rudder', 'color': cmap[3], 'style': '-' }
 
+def leg_chart(regatta, r, leg, fig, ax):
     c = regatta['courses'][r['course']]
     l = r['legs'][leg]
 
     legDataFields = ["AWA", 'STW', "TWD", "TWS", "RUD", 'Roll']
     legData = []
     for ld in legDataFields:
-        if (len(l['samples']) == 0):
+        if (len(l['samples_array']) == 0):
             print("## Leg %d No samples for %s" % (leg, ld))
         else:
-            if ld in l['samples'][0] and l['samples'][0][ld] != None:
+            if ld in l['bucket'] and not np.isnan(l['bucket'][ld][0]):
                 legData.append(ld)
 
     firstTime = l['startts'] + tzoffset
@@ -1178,27 +1339,20 @@ def leg_chart(regatta, r, leg, fig, ax):
     ax[leg].set_xlim(firstTime, lastTime)
     ax[leg].hlines(y=0, color='black', xmin=firstTime, xmax=lastTime, linestyles='--', linewidth=0.5)
 
-    hostUsed = False
-    
+    # Only make axes for the scales that have data on this leg
+    # The first scale used goes on the leg's own axis, the rest get twins
+    y_scales = {}
     for d in legData:
-        s = y_scales[plotItems[d]["scale"]]
-        if not s["in_use"]:
-            s["in_use"] = True
-            s["label"] = plotItems[d]["label"]
-            if not hostUsed:
-                s["isHost"] = True
-                s["axis"] = ax[leg]
+        scale = stripItems[d]["scale"]
+        if not scale in y_scales:
+            if len(y_scales) == 0:
+                y_scales[scale] = {"label": stripItems[d]["label"], "isHost": True, "axis": ax[leg]}
             else:
-                s["isHost"] = False
-                s['axis'] = ax[leg].twinx()
-            hostUsed = True
+                y_scales[scale] = {"label": stripItems[d]["label"], "isHost": False, "axis": ax[leg].twinx()}
         else:
-            s["label"] = "%s, %s" % (s["label"], plotItems[d]["label"])
+            y_scales[scale]["label"] = "%s, %s" % (y_scales[scale]["label"], stripItems[d]["label"])
 
-    numScales = 0
-    for scale in y_scales:
-        if s["in_use"]:
-            numScales += 1
+    numScales = len(y_scales)
     scaleWidth = 1.2 # inches for each scale
 
     scalesWidth = numScales * scaleWidth
@@ -1206,50 +1360,42 @@ def leg_chart(regatta, r, leg, fig, ax):
     scalesPct = (scalesWidth-1) /  maxPlotWidth # one scale is on the left
 
     i = 0
-    for scale in y_scales:
-        s = y_scales[scale] 
-        if s["in_use"]:
+    for scale in stripScales:
+        if scale in y_scales:
+            s = y_scales[scale]
             #print("Axis R%s L%d Axis %d: %s(%s)" % (race, leg, i, scale, s['label']))
             a = s["axis"]
             a.set_ylabel(s["label"])
             a.set_autoscaley_on(False)
-            a.set_ylim(s["min"], s["max"])
+            a.set_ylim(stripScales[scale][0], stripScales[scale][1])
             if not s['isHost']:
                 a.spines['right'].set_position(('axes', 1.0+(scalesPct * i / numScales)))
                 i += 1
 
     legendLines = []
-    portLegend = None
-    stbdLegend = None
+    # Every field is plotted against the same local sample times
+    x = [ (ts + tzoffset) for ts in l['samples_array']['ts'].tolist() ]
     for d in legData:
-        if (l['samples'][0][d] == None):
-            # Don't plot if there's no data
-            continue
-        a = y_scales[plotItems[d]['scale']]['axis']
+        a = y_scales[stripItems[d]['scale']]['axis']
 
-        x = [ (s['ts']+tzoffset) for s in l['samples'] ]
-        y = [ s[d] for s in l['samples'] ]
-        color = plotItems[d]['color']
+        y = l['bucket'][d]
+        color = stripItems[d]['color']
         a.yaxis.label.set_color(color)
         a.tick_params(axis='y', colors=color)
         a.spines['right'].set_color(color)
         #if d == 'TWS(avg)':
         #    a.hlines(y=[12, 15, 18], color=color, xmin=firstTime, xmax=lastTime, linestyles=':', linewidth=0.5)
                     
-        style = plotItems[d]['style']
+        style = stripItems[d]['style']
         #print("Plot R%s L%d B%d %s %s %s" % (race, leg, b, d, color, style))
-        smooth = scipy.signal.savgol_filter(y, 7, 3)
-        line, = a.plot(x, smooth, color=color, linestyle=style, label=plotItems[d]['label'])
+        smooth = savgol73(y)
+        line, = a.plot(x, smooth, color=color, linestyle=style, label=stripItems[d]['label'])
         legendLines.append(line)
 
     # Setting the xaxis has to come after the plot - maybe because it needs x data?
     xfmt = mdates.DateFormatter("%H:%M")
     ax[leg].xaxis.set_major_formatter(xfmt)
 
-    if portLegend:
-        legendLines.insert(0, portLegend)
-    if stbdLegend:
-        legendLines.insert(0, stbdLegend)
     ax[leg].legend(handles=legendLines, loc='best')
 
     #plt.subplot(ax[leg])
@@ -1285,7 +1431,7 @@ def strip_charts(regatta, r):
     plt.subplots_adjust(top=0.94, bottom=0.04, left=0.08, right=0.72, wspace=0.05, hspace=0.25)
     #plt.subplots_adjust(top=0.96, bottom=0.04, left=0.08, right=0.72, wspace=0.05, hspace=0.25)
     #plt.show()
-    plt.savefig("%s_%s_%s_strip" % (regatta['boat'], regatta['basefn'], r['race']), bbox_inches="tight")
+    plt.savefig(r['outbase'] + "_strip", bbox_inches="tight")
 
 ################### Polar variables
 
@@ -1315,6 +1461,8 @@ polarData = [
 def gather_polar_data(rl):
     global racecount
     global legcount
+    # The wind range for a sample is the first one whose max is greater than its TWS
+    maxTWS = np.array([polar['max'] for polar in polarData])
     for reg in rl:
         regatta = regattas[reg]
         print("## plot_polar regatta %s" % (regatta['regatta']))
@@ -1324,35 +1472,28 @@ def gather_polar_data(rl):
             legcount += len(r['legs'])
 
             for leg, l in enumerate(r['legs']):
-                for s in l['samples']:
-                    # Add this sample to the correct polar wind range
-                    twa = s['TWA']
-                    tws = s['TWS']
-                    stw = s['STW']
-                    twd = s['TWD']
-                    hdg = s['HDG']
-                    ts = s['ts']
-
-                    if tws == None:
-                        print("## Skipping sample with no TWS")
-                        continue
-                    
-                    for p, polar in enumerate(polarData):
-                        # If the max is greater than tws then this is the right bucket
-                        if type(polar['max']) != type(tws):
-                            print("## type(polar['max']): %r, type(tws): %r" % (type(polar['max']), type(tws)))
-                        if polar['max'] > tws:
-                            theta = radians(twa)
-                            datum = (theta, stw, 'red' if theta > pi else 'green', r['race'], leg, ts, twd, hdg, twa)
-                            #datum = (theta, stw, plt.cm.Set2.colors[p], int(race), leg, l['Time'][d], l['TWD(med)'][d], l['Heading'][d])
-                            polar['data'].append(datum)
-                            break
+                samples = l['samples_array']
+                missing = np.isnan(samples['TWS'])
+                if np.any(missing):
+                    print("## Skipping %d samples with no TWS" % (np.count_nonzero(missing)))
+                samples = samples[~missing]
+
+                # Add each sample to the correct polar wind range; samples above the last range are dropped
+                bucket = np.searchsorted(maxTWS, samples['TWS'], side='right')
+                for p, polar in enumerate(polarData):
+                    s = samples[bucket == p]
+                    theta = np.radians(s['TWA'])
+                    #datum = (theta, stw, plt.cm.Set2.colors[p], int(race), leg, l['Time'][d], l['TWD(med)'][d], l['Heading'][d])
+                    polar['data'].extend([(t, stw, 'red' if t > pi else 'green', r['race'], leg, ts, twd, hdg, twa) for t, stw, ts, twd, hdg, twa in
+                                          zip(theta.tolist(), s['STW'].tolist(), s['ts'].tolist(), s['TWD'].tolist(), s['HDG'].tolist(), s['TWA'].tolist())])
         
 lineSpan = 7.5
 
 # Plot performance for various wind ranges and
 # Make an aggregate plot with all wind ranges
 # Six plots fit well on a standard page
+polarColors = matplotlib.colors.to_rgba_array(['green', 'red']) # indexed by port (t > pi)
+
 def plot_polars():
     global racecount
     global legcount
@@ -1395,43 +1536,34 @@ def plot_polars():
 
         if len(pd['data']) > 0:
             t, s, c, r, leg, time, twd, hdg, twa = zip(*pd['data']) # unzip the data to theta, speed, color w/ magic * operator
-            ax.scatter(t, s, color=c, marker='.', alpha=0.05)
+            # Color each point from a two-entry RGBA table instead of having matplotlib parse a string per point
+            # The scatter is drawn as a single image since it's thousands of nearly transparent dots
+            ax.scatter(t, s, color=polarColors[(np.array(c) == 'red').astype(int)], marker='.', alpha=0.05, rasterized=True)
 
         # Sort by theta
         pd['data'].sort(key=lambda x: x[0])
         points = []
 
-        # Compute a simple per-bucket mean, but keep a list of STWs so we can use stats on it
-        bucketSTW = []
-        bucketTheta = 0
-        bucketCount = 0
-        bucket = minTWA
-        next_bucket = bucket + lineSpan
-        for d in pd['data']:
-            (theta, stw, color, raceName, leg, timeStamp, twd, hdg, twa) = d
-            while twa > next_bucket:
-                if len(bucketSTW) != 0:
-                    btheta = bucketTheta/bucketCount
-                    bmean = mean(bucketSTW)
-                    p90 = np.percentile(np.array(bucketSTW), 90)
-                    #print("## Bucket [%d] %6.1f%s (Next %4.2f%s): %d" % (len(points), bucket, deg, next_bucket, deg, bucketCount))
-                    points.append((btheta, bmean, p90, degrees(btheta)))
-                bucket = next_bucket
-                next_bucket += lineSpan
-                bucketSTW = []
-                bucketTheta = 0
-                bucketCount = 0
-            bucketSTW.append(stw)
-            bucketTheta += theta
-            bucketCount += 1
-
-        # Last bucket
-        if len(bucketSTW) != 0:
-            btheta = bucketTheta/bucketCount
-            bmean = mean(bucketSTW)
-            p90 = np.percentile(np.array(bucketSTW), 90)
-            #print("## Bucket [%d] %6.1f%s (Last): %4.1f %3.0f" % (len(points), bucket, deg, theta, degrees(theta)))
-            points.append((btheta, bmean, p90, degrees(btheta)))
+        # Compute a simple per-bucket mean and the 90th percentile of STW
+        # Buckets are lineSpan degrees of TWA wide; the first one also takes everything below minTWA
+        if len(pd['data']) > 0:
+            thetas = np.array([d[0] for d in pd['data']])
+            speeds = np.array([d[1] for d in pd['data']])
+            twas = np.array([d[8] for d in pd['data']])
+            # Each bucket is (next_bucket - lineSpan, next_bucket]
+            # A wind range can have nothing above minTWA; then everything lands in the first bucket
+            bucketEdges = np.cumsum(np.append(minTWA + lineSpan, np.full(int((max(twas.max(), minTWA) - minTWA) / lineSpan) + 1, lineSpan)))
+            buckets = np.searchsorted(bucketEdges, twas, side='left')
+            # The data is sorted so each non-empty bucket is a contiguous run
+            starts = np.flatnonzero(np.diff(buckets, prepend=-1))
+            ends = np.append(starts[1:], len(buckets))
+            counts = ends - starts
+            bthetas = np.add.reduceat(thetas, starts) / counts
+            bmeans = np.add.reduceat(speeds, starts) / counts
+            for btheta, bmean, start, end in zip(bthetas.tolist(), bmeans.tolist(), starts, ends):
+                p90 = np.quantile(speeds[start:end], 0.9)
+                #print("## Bucket [%d] %4.1f %3.0f: %d" % (len(points), btheta, degrees(btheta), end - start))
+                points.append((btheta, bmean, p90, degrees(btheta)))
 
         # make the polar lines rounder by interpolating missing points
         i = 0
@@ -1486,29 +1618,23 @@ def plot_polars():
             if scloseHauled != sgybing:
                 stheta, speed, p90, bucket = zip(*(points[scloseHauled:sgybing]))
                 print("starboard len speed: %d" % (len(speed)))
-                if len(speed) < 7:
-                    smooth = speed
-                else:
-                    smooth = scipy.signal.savgol_filter(speed, 7, 3)
+                smooth = savgol73(speed)
                 ax.plot(stheta, smooth, color='orange', linestyle='-')
-                if len(speed) < 7:
-                    ssmooth = speed
-                else:
-                    ssmooth = scipy.signal.savgol_filter(p90, 7, 3)
+                ssmooth = savgol73(p90)
                 ax.plot(stheta, ssmooth, color='blue', linestyle='-')
 
             if pcloseHauled != pgybing:
                 ptheta, speed, p90, bucket = zip(*(points[pgybing:pcloseHauled]))
                 print("port len speed: %d" % (len(speed)))
-                smooth = scipy.signal.savgol_filter(speed, 7, 3)
+                smooth = savgol73(speed)
                 ax.plot(ptheta, smooth, color='orange', linestyle='-')
-                psmooth = scipy.signal.savgol_filter(p90, 7, 3)
+                psmooth = savgol73(p90)
                 ax.plot(ptheta, psmooth, color='blue', linestyle='-')
 
             # Save these lines for drawing combined polar
             pd['p90'] = ((ptheta, psmooth, stheta, ssmooth))
 
-    pn = "%s_%s_polars" % (bn, "aggregate" if len(regattalist) > 1 else regattas[regattalist[0]]['basefn'])
+    pn = aggregate_base() + "_polars"
     plt.savefig(pn, bbox_inches="tight")
 
     # One plot with all wind ranges
@@ -1539,29 +1665,27 @@ def plot_polars():
             ax.plot(ptheta, psmooth, color=cmap[p], linewidth=2, linestyle='-', label="%2.0f kts" % (pd['min'] + ((pd['max'] - pd['min']) / 2)))
             ax.plot(stheta, ssmooth, color=cmap[p], linewidth=2, linestyle='-')
     plt.legend(loc='best')
-    pn = "%s_%s_combined_polars" % (bn, "aggregate" if len(regattalist) > 1 else regattas[regattalist[0]]['basefn'])
+    pn = aggregate_base() + "_combined_polars"
     plt.savefig(pn, bbox_inches="tight")
 
 # Generate text polars file suitable for Expedition
 def expedition_polars():
     bn = regattas[regattalist[0]]['boat']
-    en = "%s_%s_polars.txt" % (bn, "aggregate" if len(regattalist) > 1 else regattas[regattalist[0]]['basefn'])
+    en = aggregate_base() + "_polars.txt"
     with open(en, "w") as f:
         f.write("!Expedition polar - %s\n" % (bn))
         for p in range(len(polarData)):
             pd = polarData[p]
             f.write("%-4.1f" % ((pd['min'] + pd['max']) / 2.0))
-            points = []
+            twas = np.abs(np.array([d[8] for d in pd['data']]))
+            speeds = np.array([d[1] for d in pd['data']])
+            # Each angle uses only the points within 7.5 degrees of it
             for center in range(45, 181, 15):
                 c = float(center)
                 high = c - 7.5
                 low = c + 7.5
-                for d in pd['data']:
-                    (theta, stw, color, r, leg, time, twd, hdg, twa) = d
-                    twa = abs(twa)
-                    if twa > high and twa <= low:
-                        points.append(stw)
-                f.write("  %4.1f %5.2f" % (float(center), np.percentile(np.array(points), 90) if len(points) > 0 else 0))
+                points = speeds[(twas > high) & (twas <= low)]
+                f.write("  %4.1f %5.2f" % (float(center), np.quantile(points, 0.9) if len(points) > 0 else 0))
             f.write("\n")
 
 
@@ -1602,228 +1726,208 @@ def excel_date(date1):
 def expedition_log(regatta, r):
     #print('## Expedition log')
     l = r['legs']
-    c = regatta["courses"][r['course']]
 
     # Go through the race raw data, average into buckets, emit one line of data per bucket
     # Keep track of legs, advance the waypoint at the end of each leg - this puts the burden of tack/gybe on the next leg
-    buckets = []
 
     # Chop the race into buckets
-    bucketDelta = datetime.timedelta(seconds=expedition_sample_seconds)
-    bucketStart = r['startts'] # is this right? should it be start of leg 0?
-
-    index = {}
-    # Set each field to the start of the first leg
-    for field in raceRawFields:
-        index[field] = 0
+    # is this right? should it start at the start of leg 0?
+    edges = np.append(np.arange(r['startts_ms'], r['endts_ms'], expedition_sample_seconds * 1000), r['endts_ms'])
+    bucketStarts = edges[:-1]
 
     course = r['course']
     legs = regatta['courses'][course]['legs']
-    leg = 0
+    # The leg for each bucket - a bucket moves on to the next leg once it starts after the current leg's end
+    legEnds = np.array([x['endts_ms'] for x in l[:-1]], dtype=np.int64)
+    bucketLeg = np.searchsorted(legEnds, bucketStarts, side='left')
     #print("#Legs %r" % (legs))
 
-    while bucketStart < r['endts']:
-        bucket = {}
-        bucketEnd = bucketStart + bucketDelta
-        bucketEnd = min(bucketEnd, r['endts'])
-        bucket['ts'] = bucketStart
-
-        # Advance to current leg
-        while leg < (len(l)-1) and bucketStart > l[leg]['endts']:
-            leg += 1
-            #print("#Leg %d %r" % (leg, legs[leg]))
-
-        #print("#Leg %d %r" % (leg, r['legs'][leg]))
-        #bucket['mark lat'] = regatta['marks'][r['legs'][leg]['mark']]['lat']
-        #bucket['mark lon'] = regatta['marks'][r['legs'][leg]['mark']]['lon']
-
-        mark = legs[leg]['mark']
-        bucket['mark lat'] = regatta['marks'][legs[leg]['mark']]['lat']
-        bucket['mark lon'] = regatta['marks'][legs[leg]['mark']]['lon']
-
-        # Take the first lat/lon of the bucket - would mid bucket be better?
-        field = "LATLON"
-        # Advance to the beginning of the run of data for this bucket
-        while index[field] < (len(r[field])-1) and r[field][index[field]][0] < bucketStart:
-            index[field] += 1
-        bucket["LAT"] = r[field][index[field]][1]
-        bucket["LON"] = r[field][index[field]][2]
-
-        # ['AWA', 'AWS', 'STW', 'SOG', 'RUD', 'TWS']:
-        fields =['AWA', 'AWS', 'STW', 'SOG']
-
-        if 'RUD' in r and len(r['RUD']) > 0:
-            #print("Has rudder angles")
-            fields.append('RUD')
-        if 'TWS' in r and len(r['TWS']) > 0:
-            #print("Has true wind")
-            fields.append('TWS')
-        if 'Roll' in r and len(r['Roll']) > 0:
-            #print("Has heel")
-            fields.append('Roll')
-        if 'Pitch' in r and len(r['Pitch']) > 0:
-            #print("Has trim")
-            fields.append('Pitch')
-        if 'Heave' in r and len(r['Heave']) > 0:
-            #print("Has Heave")
-            fields.append('Heave')
-        if 'ROT' in r and len(r['ROT']) > 0:
-            #print("Has ROT")
-            fields.append('ROT')
-        
-        for field in fields:
-            total = 0.0
-            count = 0
-            # Advance to the beginning of the run of data for this bucket
-            #print("%s ts index[%d] max %d" % (field, index[field], len(r[field])))
-            #print("%s ts %r < bucketStart %r" % (field, r[field][index[field]][0], bucketStart))
-            while index[field] < (len(r[field])-1) and r[field][index[field]][0] < bucketStart:
-                #print("## field %s[%d] %r < %r" % (field, index[field], r[field][index[field]][0], bucketStart))
-                index[field] += 1
-            # Run through the valid data summing the value
-            while index[field] < len(r[field]) and r[field][index[field]][0] < bucketEnd:
-                d = r[field][index[field]]
-                #if len(d) < 2:
-                #print("Field %s data element too small: %r" % (field, d))
-                total += d[1]
-                count += 1
-                index[field] += 1
-            # Take the average for the bucket
-            bucket[field] = None if count == 0 else total / count
-
-        markBearing = c["legs"][leg]["bearing"]
-        # If we're going north-ish, convert COG and Heading ranges to [-180, 180] in case some samples straddle due north
-        # This is to catch the "averaging samples around due north degress leads to due south" problem - mean([0,359.999]) = 180
-        fields = ['COG', 'HDG']
-        if len(r['TWD']) > 0:
-            fields.append('TWD')
-        for field in fields:
-            total = 0.0
-            count = 0
-            # Advance to the beginning of the run of data for this bucket
-            #if index[field] > len(r[field]):
-            #print("## %s[%d]: has %d data points" % (field, index[field], len(r[field])))
-            while index[field] < (len(r[field])-1) and r[field][index[field]][0] < bucketStart:
-                index[field] += 1
-            while index[field] < len(r[field]) and r[field][index[field]][0] < bucketEnd:
-                d = r[field][index[field]]
-                # If we're going north-ish, convert COG and Heading ranges to [-180, 180] in case some samples straddle due north
-                total += d[1] if (markBearing > 90 and markBearing < 270) or (d[1] <= 180) else d[1] - 360.0
-                count += 1
-                index[field] += 1
-            if count == 0:
-                bucket[field] = None
-            else:
-                bucket[field] = total / count
-                bucket[field] += 0.0 if (markBearing > 90 and markBearing < 270) or (bucket[field] > 0) else 360.0 # Convert back to 0 - 360 if needed
-        
-        """
-        Compute TWS and TWD for this bucket
-        
-        AWA = + for Starboard, – for Port
-        AWD = H + AWA ( 0 < AWD < 360 )
-        u = SOG * Sin (COG) – AWS * Sin (AWD)
-        v = SOG * Cos (COG) – AWS * Cos (AWD)
-        TWS = SQRT ( u*u + v*v )
-        TWD = ATAN ( u / v )
-        """
-
-        if bucket['HDG'] == None or bucket['COG'] == None or bucket['SOG'] == None or bucket['AWA'] == None or bucket['AWS'] == None:
-            # Can't compute True Wind w/o HDG, COG, SOG and AWA, AWS
-            bucket['TWD'] = None
-            bucket['TWS'] = None
-            bucket['TWA'] = None
+    means = {}
+    # Take the first lat/lon of the bucket - would mid bucket be better?
+    i = np.minimum(np.searchsorted(r['LATLON']['ts'], bucketStarts), len(r['LATLON']) - 1)
+    means['LAT'] = r['LATLON']['lat'][i]
+    means['LON'] = r['LATLON']['lon'][i]
+
+    # ['AWA', 'AWS', 'STW', 'SOG', 'RUD', 'TWS']:
+    fields = ['AWA', 'AWS', 'STW', 'SOG']
+    # Only include the optional fields we have data for
+    for field in ['RUD', 'TWS', 'Roll', 'Pitch', 'Heave', 'ROT']:
+        if field in r and len(r[field]) > 0:
+            fields.append(field)
+
+    for field in fields:
+        means[field] = bucket_means(r[field].ts, r[field].v, edges)
+
+    # Average the angles on the unit circle so samples straddling due north don't average to due south
+    fields = ['COG', 'HDG']
+    if len(r['TWD']) > 0:
+        fields.append('TWD')
+    for field in fields:
+        means[field] = bucket_angle_means(r[field].ts, r[field].v, edges)
+
+    """
+    Compute TWS and TWD for each bucket
+
+    AWA = + for Starboard, – for Port
+    AWD = H + AWA ( 0 < AWD < 360 )
+    u = SOG * Sin (COG) – AWS * Sin (AWD)
+    v = SOG * Cos (COG) – AWS * Cos (AWD)
+    TWS = SQRT ( u*u + v*v )
+    TWD = ATAN ( u / v )
+    """
+
+    # Can't compute True Wind w/o HDG, COG, SOG and AWA, AWS
+    valid = ~(np.isnan(means['HDG']) | np.isnan(means['COG']) | np.isnan(means['SOG']) | np.isnan(means['AWA']) | np.isnan(means['AWS']))
+    if 'TWD' in means:
+        # TWD, TWS are done by the instruments
+        means['TWD'] = np.where(valid, means['TWD'], np.nan)
+        means['TWS'] = np.where(valid, means['TWS'], np.nan) if 'TWS' in means else np.full(len(bucketStarts), np.nan)
+    else:
+        #print("# synthesizing TWS & TWD")
+        hdg = np.radians(means['HDG'])
+        awa = np.radians(means['AWA'])
+        cog = np.radians(means['COG'])
+        awd = np.fmod(hdg + awa, tau) # Compensate for boat's heading
+        u = (means['SOG'] * np.cos(cog)) - (means['AWS'] * np.cos(awd))
+        v = (means['SOG'] * np.sin(cog)) - (means['AWS'] * np.sin(awd))
+        # Now we want to know where it's from, not where it's going, so add pi
+        means['TWS'] = np.where(valid, np.hypot(u, v), np.nan)
+        means['TWD'] = np.where(valid, np.degrees(np.fmod(np.arctan2(v, u) + pi, tau)), np.nan)
+    # Compute TWA from TWD and Heading
+    means['TWA'] = np.fmod((means['TWD'] - means['HDG']) + 360.0, 360.0)
+
+    # Every bucket has a mark, so every bucket gets a line in the log
+    marks = [regatta['marks'][legs[leg]['mark']] for leg in bucketLeg.tolist()]
+    means['mark lat'] = np.array([m['lat'] for m in marks])
+    means['mark lon'] = np.array([m['lon'] for m in marks])
+
+    # Build the log a column at a time straight from the bucket arrays, then join each line's cells
+    n = len(bucketStarts)
+    columns = []
+    for col in exp_fields:
+        bucket_field, fmt = expedition_log_map[col] if col in expedition_log_map else (None, None)
+        if bucket_field == 'boat':
+            columns.append(itertools.repeat('0', n))
+        elif bucket_field == 'ts':
+#            f.write("%f" % datetime.timestamp(b[bucket_field]))
+#            timestamp = (b['ts'] - datetime.datetime(1970, 1, 1)) / datetime.timedelta(seconds=1)
+            columns.append([fmt % (excel_date(ts)) for ts in bucketStarts.astype('datetime64[ms]').tolist()])
+        elif bucket_field in means:
+            fmt = "," + fmt
+            columns.append([(fmt % (v)) if v == v else "," for v in means[bucket_field].tolist()])
         else:
-            hdg = radians(bucket['HDG'])
-            aws = bucket['AWS']
-            awa = radians(bucket['AWA'])
-            cog = radians(bucket['COG'])
-            sog = bucket['SOG']
-
-        # Compute TWD, TWS if it's not done by the instruments
-        if not 'TWD' in bucket:
-            #print("# synthesizing TWS & TWD")
-            awd = fmod(hdg + awa, tau) # Compensate for boat's heading
-            u = (sog * cos(cog)) - (aws * cos(awd))
-            v = (sog * sin(cog)) - (aws * sin(awd))
-            tws = sqrt((u*u) + (v*v))
-            # Now we want to know where it's from, not where it's going, so add pi
-            twd = degrees(fmod(atan2(v,u)+pi, tau))
-
-            bucket['TWS'] = tws
-            bucket['TWD'] = twd
-
-        if (bucket['TWD'] != None) and (bucket['HDG'] != None):
-            # Compute TWA from TWD and Heading
-            twa = fmod((bucket['TWD'] - bucket['HDG']) + 360.0, 360.0)
-            bucket['TWA'] = twa
-        
-        bucketStart = bucketEnd
-        for key, value in bucket.items():
-            # Make sure there's at least one valid data item for this bucket
-            if key != 'ts' and value != None:
-                buckets.append(bucket) # append to the list of buckets
-                continue
+            columns.append(itertools.repeat(",", n))
 
     # This is kludgey and maybe wrong, but Expedition only runs on Windows and this is
     # where it looks for log files.
-    ofn = "C:/ProgramData/Expedition/log/%s_%s_%s_polarize.csv" % (regatta['boat'], regatta['basefn'], r['race'])
-    print('## Expedition log %s records: %d' % (ofn, len(buckets)))
+    ofn = "C:/ProgramData/Expedition/log/" + r['outbase'] + "_polarize.csv"
+    print('## Expedition log %s records: %d' % (ofn, n))
     with open(ofn, "w") as f:
-        header_string = ""
-        for field in exp_fields:
-            if field != "Boat":
-                header_string += ","
-            header_string += field
-        f.write(header_string)
+        f.write(",".join(exp_fields))
         f.write("\n")
-
-        for b in buckets:
-            for col in exp_fields:
-                if col in expedition_log_map:
-                    bucket_field = expedition_log_map[col][0]
-                    if bucket_field == 'boat':
-                        f.write('0')
-                    elif bucket_field == 'ts':
-#                        f.write("%f" % datetime.timestamp(b[bucket_field]))
-#                        timestamp = (b['ts'] - datetime.datetime(1970, 1, 1)) / datetime.timedelta(seconds=1)
-                        timestamp = excel_date(b['ts'])
-                        f.write("%f" % (timestamp))
-                    elif not bucket_field in b or b[bucket_field] == None:
-                        f.write(",")
-                    else:
-                        f.write(","+expedition_log_map[col][1] % (b[bucket_field]))
-                else:
-                    f.write(",")
+        for cells in zip(*columns):
+            f.write("".join(cells))
             f.write('\n')
 
 # Create a gpx track file. Could add waypoints for marks, tacks & gybes, etc. Could annotate w/ sensor data
-def gpx_track(regatta, r):
-    ofn = "%s_%s_%s.gpx" % (regatta['boat'], regatta['basefn'], r['race'])
-    with open(ofn, "w") as f:
-        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-        f.write('<gpx xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" version="1.1"\n')
-        f.write('creator="polarize"\n')
-        f.write('xmlns="http://www.topografix.com/GPX/1/1"\n')
-        f.write('xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd">\n')
-        now = datetime.datetime.now(datetime.timezone.utc)
-        f.write('<metadata><time>%s</time></metadata>\n' % (now.strftime("%Y-%m-%dT%H:%M:%SZ"))) # 2019-09-13T21:17:14Z
-        f.write('<trk>\n')
-        f.write('  <name>%s_%s_%s</name>\n' % (regatta['boat'], regatta['basefn'], r['race']))
-        f.write('  <trkseg>\n')
-
-        last_ts = datetime.datetime(year=1970, month=1, day=1, hour=0, minute=0, second=0)
-        for p in r['LATLON']:
-            if p[0] != last_ts:
-                tstring = p[0].strftime("%Y-%m-%dT%H:%M:%SZ")
-                f.write('    <trkpt lat="%.6f" lon="%.6f"><time>%s</time></trkpt>\n' % (p[1], p[2], tstring))
-                last_ts = p[0]
-
-        f.write('  </trkseg>\n')
-        f.write('</trk>\n')
-        f.write('</gpx>\n')
+# The fixed parts of every GPX file
+gpxHeader = (b'<?xml version="1.0" encoding="UTF-8"?>\n'
+             b'<gpx xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" version="1.1"\n'
+             b'creator="polarize"\n'
+             b'xmlns="http://www.topografix.com/GPX/1/1"\n'
+             b'xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd">\n')
+gpxTrailer = (b'  </trkseg>\n'
+              b'</trk>\n'
+              b'</gpx>\n')
+gpxSeconds = [':%02dZ' % (sec) for sec in range(60)]
+
+def gpx_track(regatta, r, runTime):
+    # runTime is the metadata time for every track from this run, like 2019-09-13T21:17:14Z
+    ofn = r['outbase'] + ".gpx"
+    if len(r['LATLON']) == 0:
+        print("## No positions for race %s - not creating %s" % (r['race'], ofn))
+        return
+    # Write bytes straight to a big buffer - the file is UTF-8 so there's no need for the text layer's encoder on every write
+    with open(ofn, "wb", buffering=1<<20) as f:
+        f.write(gpxHeader)
+        f.write(('<metadata><time>%s</time></metadata>\n<trk>\n  <name>%s</name>\n  <trkseg>\n' % (runTime, r['outbase'])).encode())
+
+        # Only the first of a run of positions with the same timestamp goes in the track
+        ts = r['LATLON']['ts']
+        keep = np.empty(len(ts), dtype=bool)
+        keep[:1] = True
+        keep[1:] = ts[1:] != ts[:-1]
+        latlon = r['LATLON'][keep]
+        ts, lat, lon = latlon['ts'], latlon['lat'], latlon['lon']
+        # Tracks have many points a minute, so format each minute once and add the seconds from a table
+        seconds = ts // 1000
+        minutes, minuteIndex = np.unique(seconds // 60, return_inverse=True)
+        minuteStrings = np.datetime_as_string(minutes.astype('datetime64[m]'), unit='m').tolist()
+        tstrings = [minuteStrings[m] + gpxSeconds[sec] for m, sec in zip(minuteIndex.tolist(), (seconds % 60).tolist())]
+
+        # Build the whole track with a single format of the repeated point template and write it at once
+        trkpt = '    <trkpt lat="%.6f" lon="%.6f"><time>%s</time></trkpt>\n'
+        f.write(((trkpt * len(ts)) % tuple(itertools.chain.from_iterable(zip(lat.tolist(), lon.tolist(), tstrings)))).encode())
+
+        f.write(gpxTrailer)
 #                f.write('<wpt lat="%.5f" lon="%.5f"><name>%s</name></wpt>\n' % (p[1], p[2], tstring))
 
+def process_race(regatta, r, args):
+    # Parse and analyze one race and write its own reports
+    parse_race(regatta, r)
+    analyze_race(regatta, r)
+
+    for leg in range(len(r["legs"])):
+        analyze_leg(regatta, r, leg)
+
+    # The GPX track only reads the race's positions, so write it in the background while the other reports are made
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as io:
+        gpx = io.submit(gpx_track, regatta, r, args.runTime) if args.gpx else None
+
+        if args.leg:
+            per_leg_report(regatta, r)
+
+        if args.strip:
+            strip_charts(regatta, r)
+
+        if args.explog:
+            expedition_log(regatta, r)
+
+        if gpx != None:
+            gpx.result() # raises anything the writer did
+
+# The parts of each analyzed leg that are used after the per-race reports
+raceResultLegKeys = ['startts', 'endts', 'duration', 'samples_array', 'boards']
+
+def process_race_worker(regatta, r, args):
+    # Process one race in a worker process and hand back the analyzed legs and report items
+    # Workers don't share our globals so set this regatta's parser settings and time zone first
+    regatta_settings(regatta)
+    process_race(regatta, r, args)
+    # Only hand back what the polars and spreadsheet use - not the raw data
+    done = {'legs': [{k: l[k] for k in raceResultLegKeys if k in l} for l in r['legs']]}
+    if 'items' in r:
+        done['items'] = r['items']
+    return(done)
+
+def process_races(races, args):
+    # Each race is independent until the polars and spreadsheet, so process them in parallel
+    # races is a list of (regatta, race) pairs
+    if len(races) < 2:
+        for regatta, r in races:
+            regatta_settings(regatta)
+            process_race(regatta, r, args)
+        return
+    # Workers get a copy of each regatta without its races - those fill in with data as the results come back
+    regattaArgs = [dict(regatta, races=[None] * len(regatta['races'])) for regatta, r in races]
+    with concurrent.futures.ProcessPoolExecutor() as pool:
+        results = pool.map(process_race_worker, regattaArgs, [r for regatta, r in races], [args] * len(races))
+        for (regatta, r), done in zip(races, results):
+            for l, dl in zip(r['legs'], done['legs']):
+                l.update(dl)
+            if 'items' in done:
+                r['items'] = done['items']
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate polars from boat data', epilog='Each regatta is usually in its own directory')
     parser.add_argument("-strip", default=False, action='store_true', dest='strip', help='Create per-race strip graph files')
@@ -1836,6 +1940,8 @@ if __name__ == '__main__':
     parser.add_argument("-gpx", default=False, action='store_true', dest='gpx', help='Create gpx track')
     parser.add_argument('regatta', nargs='*', help='Regatta JSON description files (default regatta.json)')
     args = parser.parse_args()
+    # One time for the whole run - it goes in each GPX track's metadata
+    args.runTime = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
 
     if args.regatta == []:
         print("Defaulting to regatta.json")
@@ -1845,28 +1951,7 @@ if __name__ == '__main__':
         parse_regatta(arg)
 
     regattalist.sort()
-    for rn in regattalist:
-        reg = regattas[rn]
-        tzoffset = datetime.timedelta(hours=reg['tz']) # global for this regatta
-        
-        for race in reg["races"]:
-            parse_race(reg, race)
-            analyze_race(reg, race)
-
-            for leg in range(len(race["legs"])):
-                analyze_leg(reg, race, leg)
-
-            if args.leg:
-                per_leg_report(reg, race)
-
-            if args.strip:
-                strip_charts(reg, race)
-
-            if args.gpx:
-                gpx_track(reg, race)
-
-            if args.explog:
-                expedition_log(reg, race)
+    process_races([(regattas[rn], race) for rn in regattalist for race in regattas[rn]["races"]], args)
 
     if args.polars or args.exp:
         gather_polar_data(regattalist)